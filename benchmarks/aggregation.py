@@ -0,0 +1,180 @@
+"""Benchmarks the click aggregation hot path on synthetic batch result archives.
+
+Each size builds a gzipped tarball like the ones Mailchimp serves for finished batches: JSON
+files of operation results whose `response` holds a click-details members page. The archive is
+then read (tar parsing), decoded (batch and page JSON, in-process and in the decoding pool),
+aggregated (ClickAggregate) and turned into click rates (get_url_click_rates). Every stage is
+timed and, in a separate pass, traced for peak memory. Baselines are only comparable on the
+machine that recorded them, so none is committed: record one with --save before a change, and
+later runs on that machine fail when a stage's throughput drops, or its peak memory grows, by
+more than the threshold. Without a baseline the run only prints its results.
+
+    python benchmarks/aggregation.py [--sizes 10x1000 50x5000] [--repeat N] [--save] [--threshold 0.2]
+"""
+from argparse import ArgumentParser
+from random import Random
+from time import perf_counter
+import io
+import json
+import os
+import sys
+import tarfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from aggregation import ClickAggregate, MemberTable
+from batches import read_member_files
+from decoding import decode_member_files
+from main import PAGE_SIZE, get_url_click_rates
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'aggregation-baseline.json')
+DEFAULT_SIZES = ['10x1000', '50x5000', '100x20000']
+OPERATIONS_PER_FILE = 50
+
+
+def generate_archive(links, members, seed=0):
+    # Returns the archive's bytes: `members` clickers on each of `links` links, drawn from a
+    # pool twice that size so that links share clickers, in pages of PAGE_SIZE.
+    rng = Random(seed)
+    pool = [f'member{i}@example.com' for i in range(2 * members)]
+    results = []
+    for link in range(links):
+        clickers = rng.sample(pool, members)
+        for offset in range(0, members, PAGE_SIZE):
+            page = [
+                {'email_address': email, 'clicks': 1 + int(rng.expovariate(1))}
+                for email in clickers[offset:offset + PAGE_SIZE]
+            ]
+            results.append({
+                'status_code': 200,
+                'operation_id': f'link{link}/{offset}',
+                'response': json.dumps({'members': page, 'total_items': members}),
+            })
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+        for i in range(0, len(results), OPERATIONS_PER_FILE):
+            body = json.dumps(results[i:i + OPERATIONS_PER_FILE]).encode()
+            info = tarfile.TarInfo(f'results/{i // OPERATIONS_PER_FILE}.json')
+            info.size = len(body)
+            archive.addfile(info, io.BytesIO(body))
+    return buffer.getvalue()
+
+
+def parse_tar(archive):
+    return list(read_member_files(io.BytesIO(archive)))
+
+
+def decode(files, mode='inline'):
+    return list(decode_member_files(files, mode))
+
+
+def decode_pool(files):
+    return decode(files, 'pool')
+
+
+def aggregate(pages):
+    clicks = ClickAggregate(MemberTable())
+    for operation_id, _, (_, email_clicks) in pages:
+        lid, _ = operation_id.split('/')
+        clicks.add_clicks(f'https://example.com/{lid}', lid, email_clicks)
+    return clicks
+
+
+def rates(clicks):
+    overall = {'total_clicks': sum(clicks.total(u) for u in clicks.urls()), 'unique_clicks': clicks.any_clickers()}
+    return get_url_click_rates(clicks, overall)
+
+
+def end_to_end(archive):
+    return rates(aggregate(decode_member_files(read_member_files(io.BytesIO(archive)))))
+
+
+def measure(func, arg, repeat):
+    # Returns the result, the best time of `repeat` runs and the peak memory of one traced run.
+    seconds = float('inf')
+    for _ in range(repeat):
+        start = perf_counter()
+        result = func(arg)
+        seconds = min(seconds, perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func(arg)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run_size(links, members, repeat):
+    archive = generate_archive(links, members)
+    records = links * members
+    results = {}
+    files, *results['tar'] = measure(parse_tar, archive, repeat)
+    pages, *results['decode'] = measure(decode, files, repeat)
+    _, *results['decode_pool'] = measure(decode_pool, files, repeat)
+    clicks, *results['aggregate'] = measure(aggregate, pages, repeat)
+    _, *results['rates'] = measure(rates, clicks, repeat)
+    _, *results['end_to_end'] = measure(end_to_end, archive, repeat)
+    return {
+        stage: {
+            'seconds': seconds,
+            'records_per_second': records / seconds,
+            'mb_per_second': len(archive) / seconds / 1e6,
+            'peak_memory': peak,
+        }
+        for stage, (seconds, peak) in results.items()
+    }
+
+
+def regressions(results, baseline, threshold):
+    found = []
+    for size, stages in results.items():
+        for stage, now in stages.items():
+            before = baseline.get(size, {}).get(stage)
+            if before is None:
+                continue
+            if now['records_per_second'] < before['records_per_second'] * (1 - threshold):
+                found.append(f'{size} {stage}: {now["records_per_second"]:,.0f} records/s, '
+                             f'baseline {before["records_per_second"]:,.0f}')
+            if now['peak_memory'] > before['peak_memory'] * (1 + threshold):
+                found.append(f'{size} {stage}: {now["peak_memory"] / 1e6:.1f} MB peak, '
+                             f'baseline {before["peak_memory"] / 1e6:.1f} MB')
+    return found
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='LINKSxMEMBERS (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save', action='store_true', help='record this run as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    results = {}
+    for size in args.sizes:
+        links, members = map(int, size.split('x'))
+        results[size] = run_size(links, members, args.repeat)
+        for stage, r in results[size].items():
+            print(f'{size:>10} {stage:>10}: {r["seconds"] * 1000:9.1f} ms  {r["records_per_second"]:12,.0f} records/s  '
+                  f'{r["mb_per_second"]:7.1f} MB/s  {r["peak_memory"] / 1e6:7.1f} MB peak')
+
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Baseline saved to {args.baseline}.')
+        return
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}; run with --save to record one.')
+        return
+    with open(args.baseline) as f:
+        found = regressions(results, json.load(f), args.threshold)
+    if found:
+        sys.exit('Regressions beyond {:.0%}:\n  {}'.format(args.threshold, '\n  '.join(found)))
+    print('No regressions.')
+
+
+if __name__ == '__main__':
+    main()
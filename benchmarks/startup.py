@@ -0,0 +1,86 @@
+"""Measures the task's cold start: importing it and reaching its first Google API call.
+
+Every sample runs in a fresh interpreter. Without --live, the Google clients are built from
+the on-disk discovery cache (src/discovery/) with anonymous credentials, so the samples need
+no network or secrets; with --live, secrets come from SSM and the first call is a real Drive
+request. The image fills the discovery cache at build time. In a checkout, the benchmark fills
+it first, which needs network access once, and exits with a message if it can't.
+
+    python benchmarks/startup.py [--repeat N] [--live]
+"""
+from argparse import ArgumentParser
+from statistics import median
+import json
+import os
+import subprocess
+import sys
+
+SRC_DIR = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+sys.path.insert(0, SRC_DIR)
+
+SAMPLE = '''
+import json, sys, time
+sys.path.insert(0, {src!r})
+start = time.perf_counter()
+timings = {{}}
+import main
+import google_sheet
+timings['import'] = time.perf_counter() - start
+if {live}:
+    google_sheet.secrets()
+    timings['secrets'] = time.perf_counter() - start
+    drive = google_sheet.drive_client()
+    google_sheet.sheets_client()
+    timings['build'] = time.perf_counter() - start
+    drive.files().list(pageSize=1, fields='files(id)').execute()
+    timings['first_call'] = time.perf_counter() - start
+else:
+    from google.auth.credentials import AnonymousCredentials
+    for api, version in google_sheet.GOOGLE_APIS:
+        google_sheet.build_client(api, version, AnonymousCredentials())
+    timings['build'] = time.perf_counter() - start
+print(json.dumps(timings))
+'''
+
+
+def sample(live):
+    code = SAMPLE.format(src=SRC_DIR, live=live)
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def ensure_discovery_cache():
+    # Samples without a cached discovery document would time its download instead of the start.
+    import google_sheet
+    cache = google_sheet.DiscoveryCache()
+    urls = [
+        google_sheet.GOOGLE_DISCOVERY_URL.format(api=api, apiVersion=version)
+        for api, version in google_sheet.GOOGLE_APIS
+    ]
+    if all(cache.get(url) is not None for url in urls):
+        return
+    print(f'Filling the discovery cache in {cache.directory}.')
+    try:
+        google_sheet.warm_discovery_cache()
+    except Exception as e:
+        sys.exit(f'The discovery cache in {cache.directory} is empty and could not be filled ({e}). '
+                 'Fill it from src/ with network access: '
+                 'python -c "import google_sheet; google_sheet.warm_discovery_cache()"')
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--live', action='store_true')
+    args = parser.parse_args(argv)
+
+    if not args.live:
+        ensure_discovery_cache()
+    samples = [sample(args.live) for _ in range(args.repeat)]
+    for stage in samples[0]:
+        times = [s[stage] for s in samples]
+        print(f'{stage:>10}: median {median(times) * 1000:8.1f} ms  (min {min(times) * 1000:.1f}, max {max(times) * 1000:.1f})')
+
+
+if __name__ == '__main__':
+    main()
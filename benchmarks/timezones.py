@@ -0,0 +1,51 @@
+"""Compares converting UTC epoch seconds to Central time one datetime at a time and in bulk.
+
+    python benchmarks/timezones.py [--count N] [--repeat N]
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import numpy as np
+import timezones
+
+
+def per_datetime(epochs, zone):
+    for epoch in epochs.tolist():
+        local = datetime.fromtimestamp(epoch, zone)
+        local.utcoffset()
+        local.tzname()
+
+
+def bulk(epochs, zone):
+    zone.to_local(epochs)
+
+
+def best_of(repeat, func, *args):
+    times = []
+    for _ in range(repeat):
+        start = perf_counter()
+        func(*args)
+        times.append(perf_counter() - start)
+    return min(times)
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=300_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    # A year of member activity, as Mailchimp reports it.
+    epochs = np.random.default_rng(0).integers(1577836800, 1609459200, args.count)
+    for name, func in (('per-datetime', per_datetime), ('bulk', bulk)):
+        seconds = best_of(args.repeat, func, epochs, timezones.CENTRAL)
+        print(f'{name:>12}: {seconds * 1000:9.1f} ms  ({args.count / seconds:,.0f} timestamps/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+from array import array
+from collections import defaultdict
+from math import sqrt
+from threading import Lock
+from sketches import HyperLogLog
+
+
+class MemberTable:
+    # Interns each member's email address once and hands out dense integer ids.
+
+    def __init__(self):
+        self._ids = {}
+        self._emails = []
+        self._lock = Lock()
+
+    def intern(self, email):
+        member_id = self._ids.get(email)
+        if member_id is None:
+            with self._lock:
+                member_id = self._ids.get(email)
+                if member_id is None:
+                    member_id = len(self._emails)
+                    self._ids[email] = member_id
+                    self._emails.append(email)
+        return member_id
+
+    def email(self, member_id):
+        return self._emails[member_id]
+
+    def __len__(self):
+        return len(self._emails)
+
+
+MEMBERS = MemberTable()
+
+
+class ClickAggregate:
+    # Per-link click totals in a flat counter array, and per-link clickers as bitmaps over
+    # interned member ids. A member seen twice on the same link (e.g. on two overlapping
+    # pages) is only counted once. For the history store, each link also keeps the click count
+    # of every clicker who did not click exactly once; the rest are implied by the bitmap.
+
+    def __init__(self, members=MEMBERS):
+        self.members = members
+        self._lock = Lock()
+        self._links = {}
+        self._link_urls = []
+        self._totals = array('Q')
+        self._clickers = []
+        self._counts = []
+
+    def add_page(self, url, link_id, members):
+        self.add_clicks(url, link_id, [(m['email_address'], m['clicks']) for m in members])
+
+    def add_clicks(self, url, link_id, email_clicks):
+        clicks = [(self.members.intern(email), count) for email, count in email_clicks]
+        with self._lock:
+            i = self._link_index(url, link_id)
+            bitmap = self._clickers[i]
+            counts = self._counts[i]
+            for member_id, count in clicks:
+                if _set_bit(bitmap, member_id):
+                    self._totals[i] += count
+                    if count != 1:
+                        counts[member_id] = count
+
+    def add_new_clicks(self, url, link_id, email_clicks):
+        # Adds clicks made after the link's members were read, so a member already counted on
+        # the link has the clicks added to their count rather than being skipped.
+        clicks = [(self.members.intern(email), count) for email, count in email_clicks]
+        with self._lock:
+            i = self._link_index(url, link_id)
+            counts = self._counts[i]
+            for member_id, count in clicks:
+                if not _set_bit(self._clickers[i], member_id):
+                    count += counts.get(member_id, 1)
+                if count != 1:
+                    counts[member_id] = count
+            self._totals[i] += sum(count for _, count in clicks)
+
+    def _link_index(self, url, link_id):
+        i = self._links.get(link_id)
+        if i is None:
+            i = self._links[link_id] = len(self._link_urls)
+            self._link_urls.append(url)
+            self._totals.append(0)
+            self._clickers.append(bytearray())
+            self._counts.append({})
+        return i
+
+    def urls(self):
+        return list(dict.fromkeys(self._link_urls))
+
+    def total(self, url):
+        return sum(t for u, t in zip(self._link_urls, self._totals) if u == url)
+
+    def unique(self, url):
+        return _popcount(self.clickers(url))
+
+    def clickers(self, url):
+        # Returns the members who clicked any link to url as an int bitmap.
+        bits = 0
+        for u, bitmap in zip(self._link_urls, self._clickers):
+            if u == url:
+                bits |= int.from_bytes(bitmap, 'little')
+        return bits
+
+    def any_clickers(self):
+        # Counts the members who clicked any tracked URL.
+        bits = 0
+        for bitmap in self._clickers:
+            bits |= int.from_bytes(bitmap, 'little')
+        return _popcount(bits)
+
+    def overlap(self, url_a, url_b):
+        # Counts the members who clicked both url_a and url_b.
+        return _popcount(self.clickers(url_a) & self.clickers(url_b))
+
+    def as_dict(self):
+        return {u: {'total': self.total(u), 'unique': self.unique(u)} for u in self.urls()}
+
+    def member_clicks(self):
+        # Returns (url, member ids, click counts) for each link, the last two as parallel arrays.
+        with self._lock:
+            links = [
+                (url, _set_bits(bitmap), counts)
+                for url, bitmap, counts in zip(self._link_urls, self._clickers, self._counts)
+            ]
+        return [
+            (url, array('I', member_ids), array('I', [counts.get(m, 1) for m in member_ids]))
+            for url, member_ids, counts in links
+        ]
+
+    def to_state(self):
+        # Returns a JSON-serializable snapshot that does not depend on this process's member ids.
+        members = {}
+        links = {}
+        with self._lock:
+            for lid, i in self._links.items():
+                member_ids = _set_bits(self._clickers[i])
+                links[lid] = {
+                    'url': self._link_urls[i], 'total': self._totals[i],
+                    'members': [members.setdefault(m, len(members)) for m in member_ids],
+                    'clicks': [self._counts[i].get(m, 1) for m in member_ids],
+                }
+        return {'members': [self.members.email(m) for m in members], 'links': links}
+
+    @classmethod
+    def from_state(cls, state, members=MEMBERS):
+        aggregate = cls(members)
+        member_ids = [members.intern(email) for email in state['members']]
+        for lid, link in state['links'].items():
+            i = aggregate._link_index(link['url'], lid)
+            for index, count in zip(link['members'], link['clicks']):
+                _set_bit(aggregate._clickers[i], member_ids[index])
+                if count != 1:
+                    aggregate._counts[i][member_ids[index]] = count
+            aggregate._totals[i] = link['total']
+        return aggregate
+
+
+class ClickEstimate:
+    # Per-URL click totals and unique clickers extrapolated from a sample of member pages.
+    # Each link's sample is scaled up to the number of members Mailchimp reports for it.
+
+    def __init__(self):
+        self._sketches = defaultdict(HyperLogLog)
+        self._totals = defaultdict(float)
+        self._members = defaultdict(lambda: [0, 0])
+        self._clicks = defaultdict(lambda: [0, 0])
+
+    def add_link_sample(self, url, link_members, members):
+        sketch = self._sketches[url]
+        clicks = self._clicks[url]
+        for m in members:
+            sketch.add(m['email_address'])
+            clicks[0] += m['clicks']
+            clicks[1] += m['clicks'] ** 2
+        if members:
+            self._totals[url] += sum(m['clicks'] for m in members) * link_members / len(members)
+        self._members[url][0] += link_members
+        self._members[url][1] += len(members)
+
+    def sampling_error(self, url):
+        # The relative standard error of total(url) from sampling alone, treating the sampled
+        # members as a simple random sample of the link's members, with the finite population
+        # correction so that a fully sampled URL has none.
+        expected, sampled = self._members[url]
+        total, squares = self._clicks[url]
+        if sampled < 2 or not total:
+            return 0.0
+        mean = total / sampled
+        variance = max(squares - sampled * mean * mean, 0) / (sampled - 1)
+        return sqrt(max(1 - sampled / expected, 0) * variance / sampled) / mean
+
+    @property
+    def error(self):
+        # The relative standard error of the estimate: the sketch's error combined with the
+        # worst sampling error of any URL.
+        sampling = max(map(self.sampling_error, self._sketches), default=0.0)
+        return sqrt(HyperLogLog().error ** 2 + sampling ** 2)
+
+    def urls(self):
+        return list(self._sketches)
+
+    def total(self, url):
+        return round(self._totals[url])
+
+    def unique(self, url):
+        expected, sampled = self._members[url]
+        if not sampled:
+            return 0
+        return min(round(self._sketches[url].count() * expected / sampled), expected)
+
+    def as_dict(self):
+        return {u: {'total': self.total(u), 'unique': self.unique(u)} for u in self.urls()}
+
+
+def _set_bit(bitmap, member_id):
+    # Sets the member's bit, growing the bitmap as needed, and returns whether it was newly set.
+    byte, bit = divmod(member_id, 8)
+    if byte >= len(bitmap):
+        bitmap.extend(bytes(byte - len(bitmap) + 1))
+    if bitmap[byte] >> bit & 1:
+        return False
+    bitmap[byte] |= 1 << bit
+    return True
+
+
+def _set_bits(bitmap):
+    # Returns the member ids set in a bitmap, in ascending order.
+    return [byte * 8 + bit for byte, value in enumerate(bitmap) if value for bit in range(8) if value >> bit & 1]
+
+
+def _popcount(bits):
+    return bin(bits).count('1')
@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic, sleep
+import tarfile
+from utils import logger
+from transport import session_for
+from decoding import decode_member_files
+import instrumentation
+from retry import with_backoff, RUN_BUDGET
+
+POLL_MIN_INTERVAL = 2
+POLL_MAX_INTERVAL = 60
+POLL_GROWTH = 1.5
+DOWNLOAD_WORKERS = 4
+BATCH_FIELDS = ','.join(
+    f'batches.{f}' for f in ('id', 'status', 'total_operations', 'finished_operations', 'response_body_url')
+)
+
+
+def wait_for_batches(client, batch_ids, process, workers=DOWNLOAD_WORKERS):
+    # Polls every outstanding batch together and hands each one to the worker pool as soon as
+    # it finishes, so downloading and parsing finished batches overlaps with waiting on the rest.
+    # Yields process(batch) in completion order.
+    pending = set(batch_ids)
+    running = set()
+    interval = PollInterval()
+    next_poll = 0
+    bound = instrumentation.bind(process)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            if pending and RUN_BUDGET.expired():
+                raise TimeoutError(f'Gave up waiting on {len(pending)} batch(es) at the end of the run budget.')
+            if pending and monotonic() >= next_poll:
+                statuses = poll_batches(client, pending)
+                for batch in statuses:
+                    if batch['status'] == 'finished':
+                        logger.info(f'Batch {batch["id"]} finished.')
+                        pending.discard(batch['id'])
+                        running.add(pool.submit(bound, batch))
+                interval.update(statuses)
+                next_poll = monotonic() + interval.seconds
+
+            timeout = max(next_poll - monotonic(), 0) if pending else None
+            if not running:
+                logger.info(f'Waiting {timeout:.0f} seconds for {len(pending)} batch(es).')
+                sleep(min(timeout, RUN_BUDGET.remaining()))
+                continue
+            done, running = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def poll_batches(client, batch_ids):
+    # One listing covers every recent batch; anything that has scrolled out of it is fetched directly.
+    listing = list_batches(client)
+    statuses = [b for b in listing['batches'] if b['id'] in batch_ids]
+    missing = set(batch_ids) - {b['id'] for b in statuses}
+    statuses.extend(get_batch(client, batch_id) for batch_id in missing)
+    return statuses
+
+
+@with_backoff
+def list_batches(client):
+    return client.batches.all(fields=BATCH_FIELDS, count=1000)
+
+
+@with_backoff
+def get_batch(client, batch_id):
+    fields = BATCH_FIELDS.replace('batches.', '')
+    return client.batches.get(batch_id, fields=fields)
+
+
+class PollInterval:
+    # Estimates how long until the next batch finishes from the observed operation throughput.
+
+    def __init__(self):
+        self.seconds = POLL_MIN_INTERVAL
+        self._finished = {}
+        self._polled_at = None
+
+    def update(self, statuses):
+        now = monotonic()
+        progress = sum(b['finished_operations'] - self._finished.get(b['id'], 0) for b in statuses)
+        remaining = sum(b['total_operations'] - b['finished_operations'] for b in statuses if b['status'] != 'finished')
+        if self._polled_at is not None:
+            if progress > 0 and remaining > 0:
+                eta = remaining * (now - self._polled_at) / progress
+                self.seconds = min(max(eta / 2, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL)
+            else:
+                self.seconds = min(self.seconds * POLL_GROWTH, POLL_MAX_INTERVAL)
+        self._finished = {b['id']: b['finished_operations'] for b in statuses}
+        self._polled_at = now
+
+
+def iter_batch_results(location):
+    # Yields the decoded results of a finished batch, as decoding.decode_member_file returns them.
+    with instrumentation.span('batch-results', 'download'):
+        with session_for(location).get(location, stream=True) as response:
+            response.raise_for_status()
+            # A body cut short raises rather than passing for the end of the archive.
+            response.raw.enforce_content_length = True
+            yield from decode_member_files(read_member_files(response.raw))
+            instrumentation.add_bytes(response.raw.tell())
+
+
+def read_member_files(fileobj):
+    # Streams the gzipped tarball so that only a few member files are held in memory at a time.
+    with tarfile.open(fileobj=fileobj, mode='r|gz') as tfile:
+        for member in tfile:
+            if member.isfile():
+                yield tfile.extractfile(member).read()
@@ -0,0 +1,117 @@
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from time import time
+import json
+import os
+import sqlite3
+import tempfile
+from utils import logger
+
+CACHE_DIR = os.environ.get('INSIGHT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'insight-analytics'))
+CACHE_FILE = 'responses.sqlite3'
+
+# TTLs in seconds by campaign age; campaigns older than the last bracket never change.
+CAMPAIGN_TTLS = (
+    (timedelta(days=7), 10 * 60),
+    (timedelta(days=30), 24 * 60 * 60),
+)
+UNKNOWN_CAMPAIGN_TTL = 10 * 60
+
+
+class ResponseCache:
+    # Persists Mailchimp API responses in SQLite, keyed by endpoint, campaign id and fields.
+    # Entries expire according to how long ago their campaign was sent.
+
+    def __init__(self, directory=CACHE_DIR, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self._db = None
+        self._lock = Lock()
+        self._sent_at = {}
+
+    def _connection(self):
+        if self._db is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._db = sqlite3.connect(os.path.join(self.directory, CACHE_FILE), check_same_thread=False)
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, expires REAL)'
+            )
+            self._db.execute('CREATE TABLE IF NOT EXISTS campaigns (id TEXT PRIMARY KEY, sent_at TEXT)')
+            # Expired rows are never read again, so they are dropped rather than left to pile up.
+            evicted = self._db.execute('DELETE FROM responses WHERE expires <= ?', (time(),)).rowcount
+            self._db.commit()
+            if evicted:
+                logger.info(f'Response cache: evicted {evicted} expired response(s).')
+            self._sent_at.update(self._db.execute('SELECT id, sent_at FROM campaigns'))
+        return self._db
+
+    def register_campaign(self, campaign_id, send_time):
+        # Records when a campaign was sent so its responses get an age-appropriate TTL.
+        if not self.enabled or not send_time:
+            return
+        with self._lock:
+            db = self._connection()
+            self._sent_at[campaign_id] = send_time
+            db.execute('INSERT OR REPLACE INTO campaigns VALUES (?, ?)', (campaign_id, send_time))
+            db.commit()
+
+    def ttl(self, campaign_id):
+        with self._lock:
+            self._connection()
+        send_time = self._sent_at.get(campaign_id)
+        if send_time is None:
+            return UNKNOWN_CAMPAIGN_TTL
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(send_time)
+        for max_age, ttl in CAMPAIGN_TTLS:
+            if age < max_age:
+                return ttl
+        return None
+
+    def get(self, endpoint, campaign_id=None, fields=None, params=None):
+        if not self.enabled:
+            return None
+        key = _key(endpoint, campaign_id, fields, params)
+        with self._lock:
+            row = self._connection().execute(
+                'SELECT value FROM responses WHERE key = ? AND (expires IS NULL OR expires > ?)', (key, time())
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, value, endpoint, campaign_id=None, fields=None, params=None, expires_with=None):
+        # expires_with names the campaign whose age sets the TTL when it isn't part of the key.
+        if not self.enabled:
+            return
+        ttl = self.ttl(expires_with or campaign_id)
+        expires = None if ttl is None else time() + ttl
+        with self._lock:
+            db = self._connection()
+            db.execute(
+                'INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                (_key(endpoint, campaign_id, fields, params), json.dumps(value), expires),
+            )
+            db.commit()
+
+    def fetch(self, fetch, endpoint, campaign_id=None, fields=None, params=None):
+        # Returns the cached response for the key, calling fetch() and caching its result on a miss.
+        value = self.get(endpoint, campaign_id, fields, params)
+        if value is None:
+            value = fetch()
+            self.set(value, endpoint, campaign_id, fields, params)
+        return value
+
+    def log_stats(self):
+        if self.enabled:
+            logger.info(f'Response cache: {self.hits} hit(s), {self.misses} miss(es).')
+
+
+def _key(endpoint, campaign_id, fields, params):
+    return json.dumps([endpoint, campaign_id, fields, params], sort_keys=True)
+
+
+CACHE = ResponseCache()
@@ -0,0 +1,143 @@
+from collections import defaultdict
+import json
+import os
+from aggregation import ClickAggregate
+from cache import CACHE_DIR
+from utils import logger
+
+STATE_DIR = os.environ.get('INSIGHT_STATE_DIR', CACHE_DIR)
+CHECKPOINT_FILE = 'checkpoint-{}.json'
+# An optional S3-compatible bucket, e.g. a local MinIO when CHECKPOINT_ENDPOINT is set.
+CHECKPOINT_BUCKET = os.environ.get('INSIGHT_CHECKPOINT_BUCKET')
+CHECKPOINT_ENDPOINT = os.environ.get('INSIGHT_CHECKPOINT_ENDPOINT')
+CHECKPOINT_KEY = 'insight-analytics/checkpoint-{}.json'
+
+
+class CheckpointStore:
+    # Keeps one checkpoint per campaign in a local state file, mirrored to an object store when
+    # a bucket is configured.
+
+    def __init__(self, directory=STATE_DIR, bucket=CHECKPOINT_BUCKET, endpoint_url=CHECKPOINT_ENDPOINT):
+        self.directory = directory
+        self.bucket = bucket
+        self.endpoint_url = endpoint_url
+        self._s3 = None
+
+    def s3(self):
+        if self._s3 is None:
+            import boto3
+            self._s3 = boto3.client('s3', endpoint_url=self.endpoint_url)
+        return self._s3
+
+    def path(self, campaign_id):
+        return os.path.join(self.directory, CHECKPOINT_FILE.format(campaign_id))
+
+    def read(self, campaign_id):
+        if self.bucket:
+            try:
+                body = self.s3().get_object(Bucket=self.bucket, Key=CHECKPOINT_KEY.format(campaign_id))['Body'].read()
+            except self.s3().exceptions.NoSuchKey:
+                return None
+            return json.loads(body)
+        try:
+            with open(self.path(campaign_id)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def write(self, campaign_id, state):
+        body = json.dumps(state)
+        path = self.path(campaign_id)
+        os.makedirs(self.directory, exist_ok=True)
+        with open(f'{path}.tmp', 'w') as f:
+            f.write(body)
+        os.replace(f'{path}.tmp', path)
+        if self.bucket:
+            self.s3().put_object(Bucket=self.bucket, Key=CHECKPOINT_KEY.format(campaign_id), Body=body.encode())
+
+    def clear(self, campaign_id):
+        if os.path.exists(self.path(campaign_id)):
+            os.remove(self.path(campaign_id))
+        if self.bucket:
+            self.s3().delete_object(Bucket=self.bucket, Key=CHECKPOINT_KEY.format(campaign_id))
+
+
+class Checkpoint:
+    # Tracks a campaign's progress through get_clicks_by_url: the URL to link-id map, the member
+    # pages in each submitted batch, the pages already aggregated, and the aggregate itself.
+    # Pages are only marked fetched together with the aggregate they went into, and re-adding a
+    # page never double-counts, so resuming from any saved state is exact.
+
+    def __init__(self, campaign_id, store=None):
+        self.campaign_id = campaign_id
+        self.store = store
+        self.url_link_ids = None
+        self.aggregate = ClickAggregate()
+        self.pending = {}
+        self.fetched = defaultdict(set)
+        # In watch mode, where the next read of email activity starts, and the events already
+        # folded in that it will read again.
+        self.activity_since = None
+        self.activity_seen = []
+
+    @classmethod
+    def load(cls, campaign_id, store):
+        checkpoint = cls(campaign_id, store)
+        state = store.read(campaign_id)
+        if state is None:
+            return checkpoint
+        logger.info(f'Resuming campaign {campaign_id} from checkpoint with {len(state["pending"])} pending batch(es).')
+        checkpoint.url_link_ids = state['url_link_ids']
+        checkpoint.aggregate = ClickAggregate.from_state(state['aggregate'])
+        checkpoint.pending = state['pending']
+        checkpoint.fetched.update((lid, set(offsets)) for lid, offsets in state['fetched'].items())
+        checkpoint.activity_since = state.get('activity_since')
+        checkpoint.activity_seen = state.get('activity_seen', [])
+        return checkpoint
+
+    def save(self):
+        if self.store is None:
+            return
+        self.store.write(self.campaign_id, {
+            'campaign_id': self.campaign_id,
+            'url_link_ids': self.url_link_ids,
+            'aggregate': self.aggregate.to_state(),
+            'pending': self.pending,
+            'fetched': {lid: sorted(offsets) for lid, offsets in self.fetched.items()},
+            'activity_since': self.activity_since,
+            'activity_seen': self.activity_seen,
+        })
+
+    def batch_submitted(self, batch_id, operations):
+        pages = defaultdict(list)
+        for op in operations:
+            lid, offset = op['operation_id'].split('/')
+            pages[lid].append(int(offset))
+        self.pending[batch_id] = pages
+        self.save()
+
+    def batch_processed(self, batch_id, pages):
+        # Marks the batch's pages that made it into the aggregate fetched, and returns the rest.
+        pages = set(pages)
+        failed = []
+        for lid, offsets in self.pending.pop(batch_id).items():
+            for offset in offsets:
+                if (lid, offset) in pages:
+                    self.fetched[lid].add(offset)
+                else:
+                    failed.append((lid, offset))
+        self.save()
+        return failed
+
+    def page_fetched(self, link_id, offset):
+        self.fetched[link_id].add(offset)
+
+    def pending_pages(self):
+        pages = set()
+        for batch_pages in self.pending.values():
+            pages.update((lid, offset) for lid, offsets in batch_pages.items() for offset in offsets)
+        return pages
+
+    def clear(self):
+        if self.store is not None:
+            self.store.clear(self.campaign_id)
@@ -0,0 +1,86 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+from utils import lazy
+
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
+# 'inline' decodes in the calling thread, 'pool' in worker processes, and 'auto' sends member
+# files of at least POOL_THRESHOLD bytes to the pool when there is more than one CPU to use.
+DECODE_MODE = os.environ.get('INSIGHT_DECODE_MODE', 'auto')
+POOL_THRESHOLD = int(os.environ.get('INSIGHT_DECODE_POOL_THRESHOLD', 256 * 1024))
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+
+def usable_cpus(cgroup_root=CGROUP_ROOT):
+    # The CPUs this process may actually use: os.cpu_count() is the host's count, which on
+    # Fargate is far more than the task's share, so this honours the affinity mask and the
+    # cgroup CPU quota (v2's cpu.max, or v1's cfs quota and period) when there is one.
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count() or 1
+    for path in ('cpu.max', 'cpu/cpu.cfs_quota_us'):
+        try:
+            with open(os.path.join(cgroup_root, path)) as f:
+                fields = f.read().split()
+            if path == 'cpu.max':
+                quota, period = fields
+            else:
+                with open(os.path.join(cgroup_root, 'cpu/cpu.cfs_period_us')) as f:
+                    quota, period = fields[0], f.read().strip()
+        except (OSError, ValueError):
+            continue
+        if quota not in ('max', '-1'):
+            cpus = min(cpus, max(int(quota) // int(period), 1))
+        break
+    return cpus
+
+
+DECODE_WORKERS = int(os.environ.get('INSIGHT_DECODE_WORKERS', usable_cpus()))
+
+
+def decode_member_file(payload):
+    # Decodes one member file of a batch of click-details member pages into compact results:
+    # (operation_id, status_code, (total_items, [(email, clicks), ...])) for a page, or
+    # (operation_id, status_code, response) for a failed operation.
+    results = []
+    for result in loads(payload):
+        if 'response' not in result:
+            continue
+        status = result.get('status_code', 200)
+        if status != 200:
+            results.append((result['operation_id'], status, result['response']))
+            continue
+        page = loads(result['response'])
+        clicks = [(m['email_address'], m['clicks']) for m in page['members']]
+        results.append((result['operation_id'], status, (page['total_items'], clicks)))
+    return results
+
+
+@lazy
+def decoding_pool():
+    # Spawned rather than forked, since the task has other threads running by the time it decodes.
+    return ProcessPoolExecutor(max_workers=DECODE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+
+
+def pooled(size, mode=DECODE_MODE):
+    if mode == 'auto':
+        return DECODE_WORKERS > 1 and size >= POOL_THRESHOLD
+    return mode == 'pool'
+
+
+def decode_member_files(payloads, mode=DECODE_MODE):
+    # Yields the decoded results of every member file, keeping up to two files per worker in
+    # flight while the rest of the archive is read.
+    in_flight = deque()
+    for payload in payloads:
+        if not pooled(len(payload), mode):
+            yield from decode_member_file(payload)
+            continue
+        in_flight.append(decoding_pool().submit(decode_member_file, payload))
+        if len(in_flight) >= 2 * DECODE_WORKERS:
+            yield from in_flight.popleft().result()
+    while in_flight:
+        yield from in_flight.popleft().result()
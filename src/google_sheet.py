@@ -1,23 +1,30 @@
 import json
+import os
+from collections import defaultdict
 from datetime import datetime, timedelta
-from googleapiclient.discovery import build
-from google.oauth2.service_account import Credentials
-import boto3
-from utils import logger
+from threading import Lock
+from utils import logger, lazy, debug
+import instrumentation
+from checkpoint import STATE_DIR
+from retry import with_google_backoff
+from ratelimit import API_LIMITERS, google_limiter, pool_size
+from transport import AuthorizedHttp, session_for
 import timezones
 
 
-SSM_CLIENT = boto3.client('ssm', region_name='us-east-2')
-GOOGLE_SA_JSON = SSM_CLIENT.get_parameter(Name='/insight-analytics/service-account-info', WithDecryption=True)
-GOOGLE_SA_INFO = json.loads(GOOGLE_SA_JSON['Parameter']['Value'])
+SSM_REGION = 'us-east-2'
+# Endpoint overrides, e.g. to run against tests/emulator.py.
+SSM_ENDPOINT = os.environ.get('INSIGHT_SSM_ENDPOINT')
+GOOGLE_SA_PARAMETER = '/insight-analytics/service-account-info'
+MAILCHIMP_API_KEY_PARAMETER = '/insight-analytics/mailchimp-api-key'
 SCOPES = [
     'https://www.googleapis.com/auth/spreadsheets',
     'https://www.googleapis.com/auth/drive',
 ]
-GOOGLE_CREDS = Credentials.from_service_account_info(GOOGLE_SA_INFO, scopes=SCOPES)
-
-SHEETS_CLIENT = build('sheets', 'v4', credentials=GOOGLE_CREDS)
-DRIVE_CLIENT = build('drive', 'v3', credentials=GOOGLE_CREDS)
+GOOGLE_DISCOVERY_URL = 'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
+DISCOVERY_URL = os.environ.get('INSIGHT_DISCOVERY_URL', GOOGLE_DISCOVERY_URL)
+DISCOVERY_DIR = os.environ.get('INSIGHT_DISCOVERY_DIR', os.path.join(os.path.dirname(__file__), 'discovery'))
+GOOGLE_APIS = (('sheets', 'v4'), ('drive', 'v3'))
 
 METRICS_SPREADSHEET_TEMPLATE = '1EoVKoOKPnnykMBK1bumvDWODp7mW9aAtdhE4B2qTgYY'
 SPREADSHEET_NAME_FORMAT = '%Y-%m %B'
@@ -28,28 +35,239 @@ CHART_DATA_SOURCE = 'Master!I11:I16'
 OVERVIEW_RANGE_FORMAT = '{}!B1:B3'
 URLS_RANGE_FORMAT = '{}!C6:E116'
 
-MAILCHIMP_API_SECRET = SSM_CLIENT.get_parameter(Name='/insight-analytics/mailchimp-api-key', WithDecryption=True)
-MAILCHIMP_API_KEY = MAILCHIMP_API_SECRET['Parameter']['Value']
+SPREADSHEET_MIME_TYPE = 'application/vnd.google-apps.spreadsheet'
+SPREADSHEET_FOLDER = os.environ.get('INSIGHT_SPREADSHEET_FOLDER')
+SPREADSHEET_INDEX_PATH = os.path.join(STATE_DIR, 'spreadsheets.json')
+
+
+@lazy
+def secrets():
+    import boto3
+    ssm_client = boto3.client('ssm', region_name=SSM_REGION, endpoint_url=SSM_ENDPOINT)
+    response = ssm_client.get_parameters(
+        Names=[GOOGLE_SA_PARAMETER, MAILCHIMP_API_KEY_PARAMETER], WithDecryption=True
+    )
+    if response['InvalidParameters']:
+        raise KeyError(f'Missing SSM parameters: {response["InvalidParameters"]}')
+    return {p['Name']: p['Value'] for p in response['Parameters']}
+
+
+def mailchimp_api_key():
+    return secrets()[MAILCHIMP_API_KEY_PARAMETER]
+
+
+@lazy
+def google_credentials():
+    from google.oauth2.service_account import Credentials
+    info = json.loads(secrets()[GOOGLE_SA_PARAMETER])
+    return Credentials.from_service_account_info(info, scopes=SCOPES)
+
+
+@lazy
+def sheets_client():
+    return build_client('sheets', 'v4', google_credentials())
+
+
+@lazy
+def drive_client():
+    return build_client('drive', 'v3', google_credentials())
+
+
+def build_client(api, version, credentials):
+    from googleapiclient.discovery import build
+    # Discovery documents served from an overridden URL never replace the real ones on disk.
+    cache = DiscoveryCache() if DISCOVERY_URL == GOOGLE_DISCOVERY_URL else None
+    http = AuthorizedHttp(credentials, pool_size(*API_LIMITERS[api]))
+    return build(
+        api, version, http=http, discoveryServiceUrl=DISCOVERY_URL, cache_discovery=cache is not None, cache=cache,
+    )
+
+
+class DiscoveryCache:
+    # Keeps discovery documents on disk so that building a client never has to fetch them.
+    # The image bundles them at build time through warm_discovery_cache().
+
+    def __init__(self, directory=DISCOVERY_DIR):
+        self.directory = directory
+
+    def _path(self, url):
+        return os.path.join(self.directory, url.split('/apis/')[-1].replace('/', '.').replace('.rest', '.json'))
+
+    def get(self, url):
+        try:
+            with open(self._path(url)) as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(url), 'w') as f:
+                f.write(content)
+        except OSError:
+            logger.warning(f'Could not cache discovery document for {url}.')
+
+
+def execute(request):
+    # Every attempt, retries included, waits its turn on the API's quota.
+    with instrumentation.span(request.methodId, request.methodId.split('.')[0]):
+        return with_google_backoff.call(google_limiter(request).wrap(request.execute))
+
+
+def warm_discovery_cache():
+    cache = DiscoveryCache()
+    for api, version in GOOGLE_APIS:
+        url = GOOGLE_DISCOVERY_URL.format(api=api, apiVersion=version)
+        response = session_for(url).get(url)
+        response.raise_for_status()
+        cache.set(url, response.text)
 
 
 def get_or_create_spreadsheet(spreadsheet_name):
+    # Threads asking for the same name share one lookup and, if needed, one copy of the template.
+    # The lock is per process: tasks that overlap can still each create a copy.
+    with _spreadsheet_lock(spreadsheet_name):
+        file_id = SPREADSHEET_INDEX.get(spreadsheet_name)
+        if file_id is None:
+            file_id = create_spreadsheet_from_template(spreadsheet_name)['id']
+            SPREADSHEET_INDEX.set(spreadsheet_name, file_id)
+    return file_id
+
+
+_spreadsheet_locks = defaultdict(Lock)
+_spreadsheet_locks_lock = Lock()
+
+
+def _spreadsheet_lock(spreadsheet_name):
+    with _spreadsheet_locks_lock:
+        return _spreadsheet_locks[spreadsheet_name]
+
+
+@lazy
+def spreadsheet_folder():
+    # New spreadsheets are copies of the template, so they land in the template's folder. Returns
+    # None when the service account cannot see that folder.
+    if SPREADSHEET_FOLDER:
+        return SPREADSHEET_FOLDER
+    template = execute(drive_client().files().get(fileId=METRICS_SPREADSHEET_TEMPLATE, fields='parents'))
+    return (template.get('parents') or [None])[0]
+
+
+class SpreadsheetIndex:
+    # Maps spreadsheet names to Drive file ids, persisted between runs. A remembered id is
+    # checked with a cheap files().get, and the whole index is rebuilt from one field-masked
+    # listing of the spreadsheet folder whenever a name is missing or its file is gone. A name
+    # that is still missing, e.g. because the copy landed elsewhere or the folder is unknown, is
+    # looked up across Drive by name.
+
+    def __init__(self, path=SPREADSHEET_INDEX_PATH):
+        self.path = path
+        self._ids = None
+        self._lock = Lock()
+
+    def get(self, spreadsheet_name):
+        with self._lock:
+            file_id = self._load().get(spreadsheet_name)
+        if file_id is not None and _is_live_file(file_id):
+            return file_id
+        file_id = None
+        if spreadsheet_folder() is not None:
+            self.rebuild()
+            with self._lock:
+                file_id = self._ids.get(spreadsheet_name)
+        if file_id is None:
+            file_id = _find_spreadsheet(spreadsheet_name)
+            if file_id is not None:
+                self.set(spreadsheet_name, file_id)
+        return file_id
+
+    def set(self, spreadsheet_name, file_id):
+        with self._lock:
+            self._load()[spreadsheet_name] = file_id
+            self._save()
+
+    def rebuild(self):
+        query = (
+            f"{_quote(spreadsheet_folder())} in parents and mimeType = '{SPREADSHEET_MIME_TYPE}' and trashed = false"
+        )
+        ids = {}
+        page_token = None
+        while True:
+            response = execute(drive_client().files().list(
+                q=query,
+                fields='nextPageToken,files(id,name)',
+                orderBy='createdTime',
+                pageSize=1000,
+                pageToken=page_token,
+            ))
+            for file in response['files']:
+                ids.setdefault(file['name'], file['id'])
+            page_token = response.get('nextPageToken')
+            if page_token is None:
+                break
+        logger.info(f'Indexed {len(ids)} spreadsheet(s).')
+        with self._lock:
+            self._ids = ids
+            self._save()
+
+    def _load(self):
+        if self._ids is None:
+            try:
+                with open(self.path) as f:
+                    self._ids = json.load(f)
+            except (OSError, ValueError):
+                self._ids = {}
+        return self._ids
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(f'{self.path}.tmp', 'w') as f:
+            json.dump(self._ids, f)
+        os.replace(f'{self.path}.tmp', self.path)
+
+
+def _find_spreadsheet(spreadsheet_name):
+    query = f"name = {_quote(spreadsheet_name)} and mimeType = '{SPREADSHEET_MIME_TYPE}' and trashed = false"
+    response = execute(drive_client().files().list(q=query, fields='files(id)', orderBy='createdTime', pageSize=1))
+    files = response['files']
+    return files[0]['id'] if files else None
+
+
+def _quote(value):
+    # Quotes a string for a Drive query.
+    return "'{}'".format(value.replace('\\', '\\\\').replace("'", "\\'"))
+
+
+def _is_live_file(file_id):
+    from googleapiclient.errors import HttpError
     try:
-        query = f'name = {repr(spreadsheet_name)}'
-        file = DRIVE_CLIENT.files().list(q=query).execute()['files'][0]
-    except IndexError:
-        file = create_spreadsheet_from_template(spreadsheet_name)
+        file = execute(drive_client().files().get(fileId=file_id, fields='id,trashed'))
+    except HttpError as e:
+        if e.resp.status == 404:
+            return False
+        raise
+    return not file.get('trashed', False)
+
 
-    return file['id']
+SPREADSHEET_INDEX = SpreadsheetIndex()
 
 
 def create_spreadsheet_from_template(spreadsheet_name):
-    response = DRIVE_CLIENT.files().copy(fileId=METRICS_SPREADSHEET_TEMPLATE, body={'name': spreadsheet_name}).execute()
-    fridays = get_all_fridays_for_the_month(datetime.strptime(spreadsheet_name, SPREADSHEET_NAME_FORMAT))
-    fridays = list(map(lambda x: x.strftime(SHEET_NAME_FORMAT), fridays))
-    string_fridays = list(map(lambda x: f"'{x}", fridays))
-    initialize_sheets(response['id'], fridays)
-    data = {'values': [string_fridays], 'majorDimension': 'COLUMNS'}
-    SHEETS_CLIENT.spreadsheets().values().update(spreadsheetId=response['id'], range=CHART_DATA_SOURCE, body=data, valueInputOption='USER_ENTERED').execute()
+    # The sheet renames, deletes and chart data go out in one batchUpdate right after the copy.
+    # A copy that could not be set up is deleted, so that no later run finds it by name with
+    # the template's sheets still in place.
+    response = execute(drive_client().files().copy(fileId=METRICS_SPREADSHEET_TEMPLATE, body={'name': spreadsheet_name}))
+    try:
+        fridays = get_all_fridays_for_the_month(datetime.strptime(spreadsheet_name, SPREADSHEET_NAME_FORMAT))
+        fridays = list(map(lambda x: x.strftime(SHEET_NAME_FORMAT), fridays))
+        batch = initialize_sheets(response['id'], list(fridays))
+        batch.new_cells_request(CHART_DATA_SOURCE, [fridays], major_dimension='COLUMNS')
+        batch.execute()
+    except BaseException:
+        logger.error(f'Could not set up Spreadsheet {repr(spreadsheet_name)}; deleting the copy {response["id"]}.')
+        execute(drive_client().files().delete(fileId=response['id']))
+        raise
     return response
 
 
@@ -65,22 +283,26 @@ def get_all_fridays_for_the_month(first_day_of_month):
 
 
 def initialize_sheets(spreadsheet_id, fridays):
-    spreadsheet_info = SHEETS_CLIENT.spreadsheets().get(spreadsheetId=spreadsheet_id).execute()
-    sheets = filter(lambda x: x['properties']['title'].endswith('Friday'), spreadsheet_info['sheets'])
+    spreadsheet_info = execute(sheets_client().spreadsheets().get(
+        spreadsheetId=spreadsheet_id, fields='sheets.properties(sheetId,title)'
+    ))
+    sheet_ids = {x['properties']['title']: x['properties']['sheetId'] for x in spreadsheet_info['sheets']}
+    sheets = filter(lambda x: x.endswith('Friday'), list(sheet_ids))
 
-    batch = SheetRequestBatch(spreadsheet_id)
-    for sheet in sheets:
+    batch = SheetRequestBatch(spreadsheet_id, sheet_ids)
+    for title in sheets:
         try:
-            batch.new_update_request(sheet['properties']['sheetId'], title=fridays.pop(0))
+            batch.new_update_request(sheet_ids[title], title=fridays.pop(0))
         except IndexError:
-            batch.new_delete_request(sheet['properties']['sheetId'])
+            batch.new_delete_request(sheet_ids[title])
 
-    batch.execute()
+    return batch
 
 
 class SheetRequestBatch:
-    def __init__(self, spreadsheet_id):
+    def __init__(self, spreadsheet_id, sheet_ids=None):
         self.spreadsheet_id = spreadsheet_id
+        self.sheet_ids = dict(sheet_ids or {})
         self.requests = []
 
     def new_update_request(self, sheet_id, **new_properties):
@@ -94,6 +316,11 @@ class SheetRequestBatch:
                 'fields': fields
             }
         })
+        if 'title' in new_properties:
+            for title, sid in list(self.sheet_ids.items()):
+                if sid == sheet_id:
+                    del self.sheet_ids[title]
+            self.sheet_ids[new_properties['title']] = sheet_id
 
     def new_delete_request(self, sheet_id):
         self.requests.append({
@@ -102,24 +329,73 @@ class SheetRequestBatch:
             }
         })
 
+    def new_cells_request(self, range_, values, major_dimension='ROWS'):
+        sheet_name, row, column = parse_a1_start(range_)
+        if major_dimension == 'COLUMNS':
+            values = list(zip(*values))
+        self.requests.append({
+            'updateCells': {
+                'start': {'sheetId': self.sheet_ids[sheet_name], 'rowIndex': row, 'columnIndex': column},
+                'rows': [{'values': [_cell_data(v) for v in r]} for r in values],
+                'fields': 'userEnteredValue',
+            }
+        })
+
     def execute(self):
-        SHEETS_CLIENT.spreadsheets().batchUpdate(
+        execute(sheets_client().spreadsheets().batchUpdate(
             spreadsheetId=self.spreadsheet_id,
             body={'requests': self.requests},
-        ).execute()
+        ))
+
+
+def parse_a1_start(range_):
+    # Returns the sheet name and the zero-based row and column of the range's top left cell.
+    sheet_name, cells = range_.rsplit('!', 1)
+    start = cells.split(':')[0]
+    letters = start.rstrip('0123456789')
+    column = 0
+    for letter in letters.upper():
+        column = column * 26 + ord(letter) - ord('A') + 1
+    return sheet_name.strip("'"), int(start[len(letters):]) - 1, column - 1
+
+
+def a1_cell(row, column):
+    # The inverse of parse_a1_start for one cell, e.g. (5, 27) is AB6.
+    letters = ''
+    column += 1
+    while column:
+        column, remainder = divmod(column - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return f'{letters}{row + 1}'
+
+
+def _note(timestamp):
+    return str(timestamp).partition(' — ')[2]
+
+
+def _cell_data(value):
+    if isinstance(value, bool):
+        return {'userEnteredValue': {'boolValue': value}}
+    if isinstance(value, (int, float)):
+        return {'userEnteredValue': {'numberValue': value}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
 
 
 class CellUpdateRequestBatch:
     def __init__(self, spreadsheet_id, sheet_name):
         self.spreadsheet_id = spreadsheet_id
+        self.sheet_name = sheet_name
         self.overview_range = OVERVIEW_RANGE_FORMAT.format(sheet_name)
         self.overview = None
         self.urls_range = URLS_RANGE_FORMAT.format(sheet_name)
         self.urls = None
 
-    def set_overview(self, details):
+    def set_overview(self, details, note=None):
+        timestamp = datetime.now(tz=timezones.CENTRAL).strftime(DATETIME_FORMAT)
+        if note:
+            timestamp = f'{timestamp} — {note}'
         values = [(
-            datetime.now(tz=timezones.CENTRAL).strftime(DATETIME_FORMAT),
+            timestamp,
             details['open_rate'],
             details['click_rate']
         )]
@@ -141,17 +417,139 @@ class CellUpdateRequestBatch:
             'values': values,
         }
 
-    def execute(self):
+    def data(self):
         data = []
         if self.overview:
             data.append(self.overview)
         if self.urls:
             data.append(self.urls)
-        logger.debug(data)
-        SHEETS_CLIENT.spreadsheets().values().batchUpdate(
-            spreadsheetId=self.spreadsheet_id,
-            body={
-                'valueInputOption': 'RAW',
-                'data': data
+        return data
+
+    def execute(self, diff=False):
+        if diff:
+            execute_batches([self], diff=True)
+        else:
+            update_values(self.spreadsheet_id, self.data())
+
+    def ranges(self):
+        return [d['range'] for d in self.data()]
+
+    def cells(self):
+        # Returns the values this batch writes as {(row, column): value}, zero-based.
+        cells = {}
+        for d in self.data():
+            _, row, column = parse_a1_start(d['range'])
+            for i, values in enumerate(d['values']):
+                for j, value in enumerate(values):
+                    cells[(row + j, column + i) if d['majorDimension'] == 'COLUMNS' else (row + i, column + j)] = value
+        return cells
+
+    def changes(self, current):
+        # Returns the value ranges that turn the current cells into this batch's, as rectangles
+        # of changed cells, and cells the URL block no longer fills are cleared.
+        cells = self.cells()
+        if self.urls:
+            _, top, left = parse_a1_start(self.urls_range)
+            _, bottom, right = parse_a1_start(f'{self.sheet_name}!{self.urls_range.rsplit(":", 1)[1]}')
+            for row, column in current:
+                if top <= row <= bottom and left <= column <= right:
+                    cells.setdefault((row, column), '')
+        changed = {cell: value for cell, value in cells.items() if current.get(cell, '') != value}
+        if self.overview:
+            # The timestamp only goes out with other changes, or when its note does (e.g. an estimate's).
+            timestamp = parse_a1_start(self.overview_range)[1:]
+            changed.pop(timestamp, None)
+            if changed or _note(current.get(timestamp, '')) != _note(cells[timestamp]):
+                changed[timestamp] = cells[timestamp]
+
+        # Runs of changed columns in a row, extended downwards while the next row has the same run.
+        rectangles = []
+        open_runs = {}
+        previous = None
+        for row in sorted({row for row, _ in changed}):
+            runs = []
+            for column in sorted(column for r, column in changed if r == row):
+                if runs and runs[-1][1] == column - 1:
+                    runs[-1][1] = column
+                else:
+                    runs.append([column, column])
+            if previous is not None and row != previous + 1:
+                rectangles.extend((top, previous, first, last) for (first, last), top in open_runs.items())
+                open_runs = {}
+            continued = {(first, last): open_runs.pop((first, last), row) for first, last in runs}
+            rectangles.extend((top, previous, first, last) for (first, last), top in open_runs.items())
+            open_runs = continued
+            previous = row
+        rectangles.extend((top, previous, first, last) for (first, last), top in open_runs.items())
+        return [
+            {
+                'majorDimension': 'ROWS',
+                'range': f'{self.sheet_name}!{a1_cell(top, first)}:{a1_cell(bottom, last)}',
+                'values': [[changed[r, c] for c in range(first, last + 1)] for r in range(top, bottom + 1)],
             }
-        ).execute()
+            for top, bottom, first, last in rectangles
+        ]
+
+    def execute_changes(self, current):
+        # Writes only what differs from the current cells, if anything; returns the ranges written.
+        data = self.changes(current)
+        if data:
+            update_values(self.spreadsheet_id, data)
+        logger.info(f'{len(data)} changed range(s) written to {repr(self.sheet_name)}.')
+        return data
+
+
+def execute_batches(batches, diff=False):
+    # Coalesces the cell updates of every batch into one values.batchUpdate per spreadsheet. In
+    # diff mode, each spreadsheet's ranges are read first with one values.batchGet and only the
+    # changed cells are written, so an unchanged spreadsheet costs one read and no writes.
+    spreadsheets = defaultdict(list)
+    for batch in batches:
+        spreadsheets[batch.spreadsheet_id].append(batch)
+    for spreadsheet_id, spreadsheet_batches in spreadsheets.items():
+        if diff:
+            ranges = [range_ for batch in spreadsheet_batches for range_ in batch.ranges()]
+            current = iter(read_cells(spreadsheet_id, ranges))
+            data = []
+            for batch in spreadsheet_batches:
+                cells = {}
+                for _ in batch.ranges():
+                    cells.update(next(current))
+                data.extend(batch.changes(cells))
+            logger.info(f'{len(data)} changed range(s) to write to Spreadsheet {spreadsheet_id}.')
+            if not data:
+                continue
+        else:
+            data = [d for batch in spreadsheet_batches for d in batch.data()]
+        update_values(spreadsheet_id, data)
+
+
+def read_cells(spreadsheet_id, ranges):
+    # Returns the current values of each range as {(row, column): value}, zero-based, from one
+    # values.batchGet. Numbers come back unformatted, so they compare equal to what was written.
+    response = execute(sheets_client().spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id,
+        ranges=ranges,
+        majorDimension='ROWS',
+        valueRenderOption='UNFORMATTED_VALUE',
+    ))
+    cells = []
+    for range_, value_range in zip(ranges, response.get('valueRanges', [])):
+        _, row, column = parse_a1_start(range_)
+        cells.append({
+            (row + i, column + j): value
+            for i, values in enumerate(value_range.get('values', []))
+            for j, value in enumerate(values)
+        })
+    return cells
+
+
+def update_values(spreadsheet_id, data):
+    debug(lambda: data)
+    execute(sheets_client().spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body={
+            'valueInputOption': 'RAW',
+            'data': data
+        }
+    ))
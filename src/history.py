@@ -0,0 +1,223 @@
+from datetime import datetime, timezone
+from threading import Lock
+import json
+import os
+from checkpoint import STATE_DIR
+from utils import logger
+
+HISTORY_DIR = os.environ.get('INSIGHT_HISTORY_DIR', os.path.join(STATE_DIR, 'history'))
+MANIFEST_FILE = 'manifest.json'
+MEMBERS_FILE = 'members.txt'
+# One fixed-width file per column, a row per member and URL of a campaign.
+COLUMNS = {'campaign': 'u4', 'url': 'u4', 'member': 'u4', 'clicks': 'u4'}
+
+
+class HistoryStore:
+    # Keeps the member-level clicks of every recorded campaign in append-only column files that
+    # are read through np.memmap. Member emails are interned once into a text file, one per
+    # line, and the manifest holds the URLs, the row range of each recorded campaign and how
+    # much of each file is committed. Recording a campaign again first copies every other
+    # campaign's rows into the next generation of column files, so reruns don't grow the store.
+    # Data is written before the manifest, so a crash in between only leaves bytes past the
+    # committed lengths, which the next append overwrites, or a generation nothing refers to.
+    # numpy is imported by the methods that use it, so that importing main doesn't load it.
+
+    def __init__(self, directory=HISTORY_DIR):
+        self.directory = directory
+        self._lock = Lock()
+        self._manifest = None
+        self._member_ids = None
+        self._emails = None
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def manifest(self):
+        if self._manifest is None:
+            try:
+                with open(self.path(MANIFEST_FILE)) as f:
+                    self._manifest = json.load(f)
+            except FileNotFoundError:
+                self._manifest = {
+                    'generation': 0, 'rows': 0, 'members': 0, 'members_bytes': 0, 'urls': [], 'campaigns': [],
+                }
+        return self._manifest
+
+    def emails(self):
+        # Returns every interned email, indexed by member id.
+        if self._emails is None:
+            manifest = self.manifest()
+            if not manifest['members']:
+                self._emails = []
+            else:
+                with open(self.path(MEMBERS_FILE), 'rb') as f:
+                    self._emails = f.read(manifest['members_bytes']).decode().splitlines()
+        return self._emails
+
+    def append(self, campaign_id, aggregate, sent_at=None):
+        # Records the member clicks of a finished ClickAggregate, one row per member and URL.
+        with self._lock:
+            try:
+                rows = self._append(campaign_id, aggregate, sent_at)
+            except BaseException:
+                # The in-memory state may be ahead of the files now; reload it on next use.
+                self._manifest = self._member_ids = self._emails = None
+                raise
+        logger.info(f'Recorded {rows} member click row(s) of campaign {campaign_id} in the history.')
+
+    def column_path(self, name, generation=None):
+        if generation is None:
+            generation = self.manifest()['generation']
+        return self.path(f'{name}.{generation}.{COLUMNS[name]}' if generation else f'{name}.{COLUMNS[name]}')
+
+    def _append(self, campaign_id, aggregate, sent_at):
+        import numpy as np
+        manifest = self.manifest()
+        replaced = manifest['generation']
+        if any(c['id'] == campaign_id for c in manifest['campaigns']):
+            self._compact(campaign_id)
+        if self._member_ids is None:
+            self._member_ids = {email: i for i, email in enumerate(self.emails())}
+        url_ids = {url: i for i, url in enumerate(manifest['urls'])}
+
+        new_emails = []
+        url_column = [np.empty(0, dtype=COLUMNS['url'])]
+        member_column = [np.empty(0, dtype=COLUMNS['member'])]
+        clicks_column = [np.empty(0, dtype=COLUMNS['clicks'])]
+        member_map = {}
+        for url, member_ids, counts in aggregate.member_clicks():
+            url_id = url_ids.get(url)
+            if url_id is None:
+                url_id = url_ids[url] = len(manifest['urls'])
+                manifest['urls'].append(url)
+            for member_id in member_ids:
+                if member_id not in member_map:
+                    email = aggregate.members.email(member_id)
+                    history_id = self._member_ids.get(email)
+                    if history_id is None:
+                        history_id = self._member_ids[email] = len(self._emails)
+                        self._emails.append(email)
+                        new_emails.append(email)
+                    member_map[member_id] = history_id
+            url_column.append(np.full(len(member_ids), url_id, dtype=COLUMNS['url']))
+            member_column.append(np.array([member_map[m] for m in member_ids], dtype=COLUMNS['member']))
+            clicks_column.append(np.frombuffer(counts, dtype=COLUMNS['clicks']))
+
+        # A member who clicked several links to the same URL gets one row with the sum.
+        keys = np.concatenate(url_column).astype('u8') << 32 | np.concatenate(member_column)
+        keys, inverse = np.unique(keys, return_inverse=True)
+        clicks = np.bincount(inverse, weights=np.concatenate(clicks_column), minlength=len(keys))
+        slot = len(manifest['campaigns'])
+        columns = {
+            'campaign': np.full(len(keys), slot),
+            'url': keys >> 32,
+            'member': keys & 0xFFFFFFFF,
+            'clicks': clicks,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        start = manifest['rows']
+        for name, dtype in COLUMNS.items():
+            _write_at(self.column_path(name), start * np.dtype(dtype).itemsize, columns[name].astype(dtype).tobytes())
+        members_bytes = _write_at(self.path(MEMBERS_FILE), manifest['members_bytes'],
+                                  ''.join(f'{e}\n' for e in new_emails).encode())
+
+        manifest['campaigns'].append({
+            'id': campaign_id,
+            'sent_at': sent_at,
+            'recorded_at': datetime.now(timezone.utc).isoformat(),
+            'start': start,
+            'stop': start + len(keys),
+        })
+        manifest['rows'] = start + len(keys)
+        manifest['members'] = len(self._emails)
+        manifest['members_bytes'] = members_bytes
+        with open(self.path(f'{MANIFEST_FILE}.tmp'), 'w') as f:
+            json.dump(manifest, f)
+        os.replace(self.path(f'{MANIFEST_FILE}.tmp'), self.path(MANIFEST_FILE))
+        if replaced != manifest['generation']:
+            for name in COLUMNS:
+                os.remove(self.column_path(name, replaced))
+        return len(keys)
+
+    def _compact(self, campaign_id):
+        # Copies the rows of every other campaign into the next generation of column files and
+        # points the in-memory manifest at them. Interned emails are kept, since ids must stay.
+        import numpy as np
+        manifest = self.manifest()
+        kept = [c for c in manifest['campaigns'] if c['id'] != campaign_id]
+        slots = np.zeros(len(manifest['campaigns']), dtype=COLUMNS['campaign'])
+        slots[[i for i, c in enumerate(manifest['campaigns']) if c['id'] != campaign_id]] = np.arange(len(kept))
+        generation = manifest['generation'] + 1
+        os.makedirs(self.directory, exist_ok=True)
+        for name in COLUMNS:
+            column = self.column(name)
+            with open(self.column_path(name, generation), 'wb') as f:
+                for campaign in kept:
+                    rows = column[campaign['start']:campaign['stop']]
+                    f.write((slots[rows] if name == 'campaign' else rows).tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        start = 0
+        for campaign in kept:
+            campaign['start'], campaign['stop'] = start, start + campaign['stop'] - campaign['start']
+            start = campaign['stop']
+        manifest.update(generation=generation, rows=start, campaigns=kept)
+
+    def column(self, name):
+        import numpy as np
+        rows = self.manifest()['rows']
+        if not rows:
+            return np.empty(0, dtype=COLUMNS[name])
+        return np.memmap(self.column_path(name), dtype=COLUMNS[name], mode='r', shape=(rows,))
+
+    def campaigns(self, last=None):
+        # Returns each recorded campaign, oldest first, or only the last few.
+        current = sorted(self.manifest()['campaigns'], key=lambda c: c['sent_at'] or c['recorded_at'])
+        return current[-last:] if last else current
+
+    def engagement(self, last=None):
+        # Counts, per member id, how many of the campaigns they clicked any URL in.
+        import numpy as np
+        members = self.column('member')
+        counts = np.zeros(self.manifest()['members'], dtype='u4')
+        for campaign in self.campaigns(last):
+            counts[np.unique(members[campaign['start']:campaign['stop']])] += 1
+        return counts
+
+    def engaged_members(self, min_campaigns, last=None):
+        # Returns the emails of members who clicked in at least min_campaigns of the campaigns,
+        # e.g. engaged_members(4, last=8) for those who clicked in 4 of the last 8 issues.
+        import numpy as np
+        emails = self.emails()
+        return [emails[i] for i in np.flatnonzero(self.engagement(last) >= min_campaigns)]
+
+    def url_clicks(self, last=None):
+        # Returns {url: (total clicks, campaigns)} over the campaigns, for URLs that got clicks.
+        import numpy as np
+        urls, clicks = self.column('url'), self.column('clicks')
+        totals = np.zeros(len(self.manifest()['urls']), dtype='u8')
+        campaigns = np.zeros(len(totals), dtype='u4')
+        for campaign in self.campaigns(last):
+            rows = slice(campaign['start'], campaign['stop'])
+            totals += np.bincount(urls[rows], weights=clicks[rows], minlength=len(totals)).astype('u8')
+            campaigns[np.unique(urls[rows])] += 1
+        return {
+            url: (int(totals[i]), int(campaigns[i]))
+            for i, url in enumerate(self.manifest()['urls']) if totals[i]
+        }
+
+
+def _write_at(path, offset, data):
+    # Writes data at offset, dropping anything past it, and returns the new committed length.
+    with open(path, 'r+b' if os.path.exists(path) else 'wb') as f:
+        f.seek(offset)
+        f.truncate()
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    return offset + len(data)
+
+
+HISTORY = HistoryStore()
@@ -0,0 +1,154 @@
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from threading import Lock, local
+from time import perf_counter
+import json
+import os
+import tracemalloc
+from cache import CACHE_DIR
+from utils import logger
+
+SUMMARY_PATH = os.environ.get('INSIGHT_RUN_SUMMARY', os.path.join(CACHE_DIR, 'run-summary.json'))
+# tracemalloc slows every allocation down, so memory peaks are only recorded when asked for.
+TRACE_MEMORY = os.environ.get('INSIGHT_TRACE_MEMORY') == '1'
+# Runs the whole task under cProfile and writes its stats to this path.
+PROFILE_PATH = os.environ.get('INSIGHT_PROFILE')
+
+
+class Span:
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.wall = 0.0
+        self.bytes = 0
+        self.retries = 0
+        self.peak_memory = 0
+
+
+class Recorder:
+    # Collects finished spans. Each thread keeps a stack of its open spans, so bytes and retries
+    # are credited to every span the current call is nested in. Work handed to a thread pool is
+    # wrapped with bind(), which carries the submitting thread's stack over to the worker, so it
+    # is still credited to the stage that started it. Work in the decoding processes is not
+    # seen at all beyond the wall time the submitting span spends waiting on it. Memory peaks
+    # are exact even with spans open on several threads: tracemalloc's peak is folded into every
+    # open span and reset whenever a span starts or ends.
+
+    def __init__(self):
+        self.started = perf_counter()
+        self.started_at = datetime.now(timezone.utc)
+        self.spans = []
+        self._open = set()
+        self._lock = Lock()
+        self._local = local()
+
+    def stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+    def _fold_peak(self):
+        if not tracemalloc.is_tracing():
+            return
+        peak = tracemalloc.get_traced_memory()[1]
+        for span in self._open:
+            span.peak_memory = max(span.peak_memory, peak)
+        tracemalloc.reset_peak()
+
+    def bind(self, func):
+        # Returns func wrapped to run under the spans open in the calling thread, for submitting
+        # to a thread pool.
+        parents = list(self.stack())
+
+        def bound(*args, **kwargs):
+            stack = self.stack()
+            outer = stack[:]
+            stack[:] = parents
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack[:] = outer
+        return bound
+
+    @contextmanager
+    def span(self, name, kind):
+        span = Span(name, kind)
+        with self._lock:
+            self._fold_peak()
+            self._open.add(span)
+        self.stack().append(span)
+        start = perf_counter()
+        try:
+            yield span
+        finally:
+            span.wall = perf_counter() - start
+            self.stack().pop()
+            with self._lock:
+                self._fold_peak()
+                self._open.discard(span)
+                self.spans.append(span)
+
+    def add_bytes(self, count):
+        for span in self.stack():
+            span.bytes += count
+
+    def add_retry(self):
+        for span in self.stack():
+            span.retries += 1
+
+    def summary(self):
+        with self._lock:
+            spans = list(self.spans)
+        calls = defaultdict(lambda: {'calls': 0, 'wall': 0.0, 'max_wall': 0.0, 'bytes': 0, 'retries': 0})
+        for span in spans:
+            if span.kind == 'stage':
+                continue
+            totals = calls[f'{span.kind}:{span.name}']
+            totals['calls'] += 1
+            totals['wall'] += span.wall
+            totals['max_wall'] = max(totals['max_wall'], span.wall)
+            totals['bytes'] += span.bytes
+            totals['retries'] += span.retries
+        return {
+            'started_at': self.started_at.isoformat(),
+            'wall': perf_counter() - self.started,
+            'peak_memory': tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else None,
+            'stages': [
+                {'name': s.name, 'wall': s.wall, 'bytes': s.bytes, 'retries': s.retries, 'peak_memory': s.peak_memory}
+                for s in spans if s.kind == 'stage'
+            ],
+            'calls': dict(calls),
+        }
+
+
+RECORDER = Recorder()
+span = RECORDER.span
+bind = RECORDER.bind
+add_bytes = RECORDER.add_bytes
+add_retry = RECORDER.add_retry
+
+
+def start():
+    if TRACE_MEMORY and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def write_summary(path=SUMMARY_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(RECORDER.summary(), f, indent=2)
+    logger.info(f'Run summary written to {path}.')
+
+
+def profiled(func, *args, path=PROFILE_PATH):
+    # Calls func, under cProfile when a stats path is configured.
+    if not path:
+        return func(*args)
+    import cProfile
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(func, *args)
+    finally:
+        profile.dump_stats(path)
+        logger.info(f'Profile written to {path}.')
@@ -1,58 +1,344 @@
-from collections import defaultdict
-from datetime import datetime, timedelta
-from io import BytesIO
-import tarfile
-import json
-import requests
+from argparse import ArgumentParser, ArgumentTypeError
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import date, datetime, timedelta, timezone
+from random import Random
+from time import perf_counter, sleep, time
+import os
 from mailchimp3 import MailChimp
-from utils import with_backoff, with_backoff_condition, logger
-from google_sheet import get_or_create_spreadsheet, CellUpdateRequestBatch, MAILCHIMP_API_KEY
+from utils import logger, debug
+from retry import with_backoff, with_download_backoff, start_run
+from batches import wait_for_batches, iter_batch_results
+from aggregation import ClickEstimate
+from cache import CACHE
+from checkpoint import Checkpoint, CheckpointStore
+from history import HISTORY
+from pipeline import Pipeline
+from ratelimit import LIMITERS, log_limiter_stats
+import transport
+import instrumentation
+from google_sheet import (
+    get_or_create_spreadsheet, execute_batches, CellUpdateRequestBatch, mailchimp_api_key,
+    SPREADSHEET_NAME_FORMAT, SHEET_NAME_FORMAT,
+)
 
 GSHEET_TEMPLATE_ID = '1EoVKoOKPnnykMBK1bumvDWODp7mW9aAtdhE4B2qTgYY'
+CAMPAIGN_NAME_FORMAT = 'Friday %B %-d %Y'
+MEMBERS_ENDPOINT = 'click-details/members'
+MEMBER_FIELDS = 'total_items,members.email_address,members.clicks'
+PAGE_SIZE = 1000
+PAGE_WORKERS = 4
+DEFAULT_SAMPLE_FRACTION = 0.1
+MAX_BATCH_OPERATIONS = 1000
+# Up to this many member pages are fetched with direct calls; the batch API's queueing only pays
+# off for more. A link needs one page per PAGE_SIZE members who clicked it (its unique_clicks).
+DIRECT_FETCH_MAX_PAGES = int(os.environ.get('INSIGHT_DIRECT_FETCH_MAX_PAGES', 40))
+BACKFILL_WORKERS = 4
+# Watch mode refreshes until this many hours after the send, when engagement has mostly settled.
+WATCH_HOURS = float(os.environ.get('INSIGHT_WATCH_HOURS', 48))
+# Each refresh reads email activity again this far back, for events Mailchimp records late.
+ACTIVITY_OVERLAP = timedelta(minutes=10)
+ACTIVITY_FIELDS = 'total_items,emails.email_address,emails.activity'
 
 
+# Overrides the API root derived from the key's datacenter, e.g. to run against tests/emulator.py.
+MAILCHIMP_URL = os.environ.get('INSIGHT_MAILCHIMP_URL')
+
 mc_client = None
+# Send times of the campaigns looked up so far, by campaign id, to order them in the history.
+send_times = {}
+
 
+def main(argv=None):
+    args = parse_args(argv)
+    start_run()
+    CACHE.enabled = not args.no_cache
+    # The stats are logged however the run ends, since a failed run is when they matter most.
+    try:
+        if args.backfill:
+            backfill(*args.backfill, workers=args.workers, diff=args.diff)
+        elif args.watch:
+            watch(args.watch, diff=args.diff)
+        else:
+            report_last_friday(args)
+    finally:
+        CACHE.log_stats()
+        log_limiter_stats()
+        transport.log_connection_stats()
 
-def main():
+
+def report_last_friday(args):
+    # Writes the report of the last Friday newsletter.
     campaign_name, spreadsheet_name, sheet_name = extrapolate_vars()
     logger.info(f'Extracting metrics from {repr(campaign_name)}.')
-    campaign_id = find_campaign_id(campaign_name)
-    logger.info(f'Mailchimp Campaign Id: {campaign_id}')
-    click_details = get_click_details(campaign_id)
-    url_link_ids = group_links_by_url(campaign_id)
-    url_details = get_clicks_by_url(campaign_id, url_link_ids)
-    url_click_info = get_url_click_rates(url_details, click_details)
 
+    def write(spreadsheet_id, click_details, url_details, note=None):
+        logger.info(f'Saving data to Spreadsheet {repr(spreadsheet_name)} — {spreadsheet_id}')
+        batch = CellUpdateRequestBatch(spreadsheet_id, sheet_name)
+        batch.set_overview(click_details, note=note)
+        batch.set_urls(get_url_click_rates(url_details, click_details))
+        batch.execute(diff=args.diff)
+
+    def find_campaign():
+        campaign_id = find_campaign_id(campaign_name)
+        logger.info(f'Mailchimp Campaign Id: {campaign_id}')
+        return campaign_id
+
+    def write_exact(spreadsheet_id, click_details, url_details, *estimate):
+        write(spreadsheet_id, click_details, url_details)
+
+    def write_estimate(campaign_id, checkpoint, spreadsheet_id, click_details):
+        # Only a preview: if it fails, the exact report is still written.
+        try:
+            estimate = estimate_clicks_by_url(campaign_id, checkpoint.url_link_ids, args.sample_fraction)
+            note = f'Preliminary estimate (±{estimate.error:.1%}, {args.sample_fraction:.0%} of member pages sampled)'
+            write(spreadsheet_id, click_details, estimate, note=note)
+        except Exception:
+            logger.exception('Could not write the preliminary estimate; writing the exact report only.')
+
+    # The spreadsheet only depends on its name, and the click report only on the campaign id,
+    # so each runs alongside the other stages. The exact report is written after any estimate.
+    pipeline = Pipeline()
+    pipeline.stage('campaign_id', find_campaign)
+    pipeline.stage('spreadsheet_id', lambda: get_or_create_spreadsheet(spreadsheet_name))
+    pipeline.stage('click_details', get_click_details, 'campaign_id')
+    pipeline.stage('checkpoint', load_checkpoint, 'campaign_id')
+    pipeline.stage(
+        'url_details', lambda c, checkpoint: get_clicks_by_url(c, checkpoint.url_link_ids, checkpoint),
+        'campaign_id', 'checkpoint',
+    )
+    estimate = []
+    if args.approximate:
+        pipeline.stage('estimate', write_estimate, 'campaign_id', 'checkpoint', 'spreadsheet_id', 'click_details')
+        estimate.append('estimate')
+    pipeline.stage('write', write_exact, 'spreadsheet_id', 'click_details', 'url_details', *estimate)
+    results = pipeline.run()
+
+    results['checkpoint'].clear()
+
+
+def backfill(start, end, workers=BACKFILL_WORKERS, diff=False):
+    spreadsheets = defaultdict(list)
+    for friday in fridays_between(start, end):
+        campaign_name, spreadsheet_name, sheet_name = campaign_vars(friday)
+        spreadsheets[spreadsheet_name].append((campaign_name, sheet_name))
+    spreadsheet_ids = {name: get_or_create_spreadsheet(name) for name in spreadsheets}
+
+    def report(campaign_name, spreadsheet_name, sheet_name):
+        start_run()
+        logger.info(f'Extracting metrics from {repr(campaign_name)}.')
+        campaign_id = find_campaign_id(campaign_name)
+        click_details = get_click_details(campaign_id)
+        checkpoint = load_checkpoint(campaign_id)
+        url_details = get_clicks_by_url(campaign_id, checkpoint.url_link_ids, checkpoint)
+        batch = CellUpdateRequestBatch(spreadsheet_ids[spreadsheet_name], sheet_name)
+        batch.set_overview(click_details)
+        batch.set_urls(get_url_click_rates(url_details, click_details))
+        return batch, checkpoint
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(instrumentation.bind(report), campaign_name, spreadsheet_name, sheet_name): campaign_name
+            for spreadsheet_name, campaigns in spreadsheets.items()
+            for campaign_name, sheet_name in campaigns
+        }
+        reports = []
+        for future in as_completed(futures):
+            try:
+                reports.append(future.result())
+            except Exception:
+                logger.exception(f'Could not extract metrics from {repr(futures[future])}.')
+
+    logger.info(f'Saving {len(reports)} report(s) to {len(spreadsheet_ids)} spreadsheet(s).')
+    execute_batches([batch for batch, _ in reports], diff=diff)
+    for _, checkpoint in reports:
+        checkpoint.clear()
+
+
+def watch(minutes, diff=False):
+    campaign_name, spreadsheet_name, sheet_name = extrapolate_vars()
+    campaign_id = find_campaign_id(campaign_name)
     spreadsheet_id = get_or_create_spreadsheet(spreadsheet_name)
-    logger.info(f'Saving data to Spreadsheet {repr(spreadsheet_name)} — {spreadsheet_id}')
-    batch = CellUpdateRequestBatch(spreadsheet_id, sheet_name)
-    batch.set_overview(click_details)
-    batch.set_urls(url_click_info)
-    batch.execute()
+    checkpoint = load_checkpoint(campaign_id)
+    if checkpoint.activity_since is None:
+        # Activity is only read from the end of the extraction on, so no click is counted both in
+        # a member page and as activity. A click made while a long extraction ran, after its
+        # page was read, is left to the next full run.
+        get_clicks_by_url(campaign_id, checkpoint.url_link_ids, checkpoint)
+        checkpoint.activity_since = datetime.now(timezone.utc).isoformat()
+        checkpoint.save()
+
+    sent_at = send_times.get(campaign_id)
+    deadline = (datetime.fromisoformat(sent_at) if sent_at else datetime.now(timezone.utc)) + timedelta(hours=WATCH_HOURS)
+    logger.info(f'Refreshing {repr(campaign_name)} every {minutes:g} minute(s) until {deadline.isoformat()}.')
+    written = None
+    refreshes = 0
+    while True:
+        start_run()
+        # A refresh that fails after its retries is logged and tried again at the next one; the
+        # activity it did not fold and the cells it did not write are still pending then.
+        try:
+            if refreshes:
+                start = perf_counter()
+                clicks = fold_email_activity(campaign_id, checkpoint)
+                logger.info(f'Folded {clicks} new click(s) into {repr(campaign_name)} in {perf_counter() - start:.2f}s.')
+            click_details = get_click_details(campaign_id, fresh=True)
+            batch = CellUpdateRequestBatch(spreadsheet_id, sheet_name)
+            batch.set_overview(click_details)
+            batch.set_urls(get_url_click_rates(checkpoint.aggregate, click_details))
+            if written is None:
+                batch.execute(diff=diff)
+            else:
+                batch.execute_changes(written)
+            written = batch.cells()
+        except Exception:
+            logger.exception(f'Could not refresh {repr(campaign_name)}; trying again in {minutes:g} minute(s).')
+        refreshes += 1
+
+        if time() + minutes * 60 >= deadline.timestamp():
+            break
+        sleep(minutes * 60)
+    checkpoint.clear()
+
+
+def fold_email_activity(campaign_id, checkpoint):
+    # Adds the clicks recorded since the last refresh to the checkpoint's aggregate. The next
+    # refresh reads back ACTIVITY_OVERLAP before this one started, for events Mailchimp records
+    # late, and skips the ones folded in here.
+    started = datetime.now(timezone.utc)
+    since = datetime.fromisoformat(checkpoint.activity_since)
+    seen = Counter({tuple(key): count for *key, count in checkpoint.activity_seen})
+    url_link_ids = {url: next(iter(link_ids)) for url, link_ids in checkpoint.url_link_ids.items()}
+    events = Counter()
+    for member in iter_email_activity(campaign_id, since.isoformat()):
+        for event in member['activity']:
+            if event['action'] == 'click' and datetime.fromisoformat(event['timestamp']) > since:
+                events[member['email_address'], event['timestamp'], event['url']] += 1
+
+    clicks = defaultdict(Counter)
+    for (email, _, url), count in (events - seen).items():
+        clicks[url][email] += count
+    for url, email_clicks in clicks.items():
+        # Clicks on a URL go to one of its links; per-URL totals and clickers are what is reported.
+        checkpoint.aggregate.add_new_clicks(url, url_link_ids.get(url, url), email_clicks.items())
+
+    checkpoint.activity_since = (started - ACTIVITY_OVERLAP).isoformat()
+    checkpoint.activity_seen = [
+        [*key, count] for key, count in events.items()
+        if datetime.fromisoformat(key[1]) > started - ACTIVITY_OVERLAP
+    ]
+    checkpoint.save()
+    return sum(sum(c.values()) for c in clicks.values())
+
+
+def iter_email_activity(campaign_id, since):
+    offset = 0
+    while True:
+        page = fetch_email_activity(campaign_id, since, offset)
+        yield from page['emails']
+        offset += PAGE_SIZE
+        if offset >= page['total_items']:
+            return
+
+
+@with_backoff
+def fetch_email_activity(campaign_id, since, offset):
+    return mailchimp_client().reports.email_activity.all(
+        campaign_id=campaign_id,
+        fields=ACTIVITY_FIELDS,
+        count=PAGE_SIZE,
+        offset=offset,
+        since=since,
+    )
+
+
+def sample_fraction(value):
+    fraction = float(value)
+    if not 0 < fraction <= 1:
+        raise ArgumentTypeError(f'{value} is not in (0, 1]')
+    return fraction
+
+
+def parse_args(argv):
+    parser = ArgumentParser(description='Exports the click report of the last Friday newsletter to Google Sheets.')
+    parser.add_argument(
+        '--approximate', action='store_true',
+        help='write a sampled estimate to the sheet first, then overwrite it with the exact report',
+    )
+    parser.add_argument(
+        '--sample-fraction', type=sample_fraction, default=DEFAULT_SAMPLE_FRACTION,
+        help='fraction of member pages sampled for the estimate (default: %(default)s)',
+    )
+    parser.add_argument('--no-cache', action='store_true', help='bypass the Mailchimp response cache')
+    parser.add_argument(
+        '--backfill', nargs=2, metavar=('START', 'END'), type=date.fromisoformat,
+        help='report every Friday newsletter between two YYYY-MM-DD dates, inclusive',
+    )
+    parser.add_argument(
+        '--workers', type=int, default=BACKFILL_WORKERS,
+        help='campaigns processed concurrently during a backfill (default: %(default)s)',
+    )
+    parser.add_argument(
+        '--diff', action='store_true',
+        help='read the cells first and only write those that changed, and the timestamp if any did',
+    )
+    parser.add_argument(
+        '--watch', type=float, metavar='MINUTES',
+        help=f'keep the current report up to date every MINUTES until {WATCH_HOURS:g} hours after the send',
+    )
+    return parser.parse_args(argv)
 
 
 def extrapolate_vars():
     today = datetime.today()
     delta_to_last_friday = timedelta(days=(today.weekday() - 4) % 7)
-    friday = today - delta_to_last_friday
-    return friday.strftime('Friday %B %-d %Y'), friday.strftime('%Y-%m %B'), friday.strftime('%B %-d')
+    return campaign_vars(today - delta_to_last_friday)
+
+
+def campaign_vars(friday):
+    return friday.strftime(CAMPAIGN_NAME_FORMAT), friday.strftime(SPREADSHEET_NAME_FORMAT), friday.strftime(SHEET_NAME_FORMAT)
+
+
+def fridays_between(start, end):
+    friday = start + timedelta(days=(4 - start.weekday()) % 7)
+    while friday <= end:
+        yield friday
+        friday += timedelta(days=7)
+
+
+def load_checkpoint(campaign_id):
+    checkpoint = Checkpoint.load(campaign_id, CheckpointStore())
+    if checkpoint.url_link_ids is None:
+        checkpoint.url_link_ids = group_links_by_url(campaign_id)
+        checkpoint.save()
+    return checkpoint
 
 
-@with_backoff
 def find_campaign_id(search_query):
-    search_results = mailchimp_client().search_campaigns.get(
-        query=search_query, fields='results.campaign.id'
-        )
-    return search_results['results'][0]['campaign']['id']
+    fields = 'results.campaign.id,results.campaign.send_time'
+    search_results = CACHE.get('search-campaigns', fields=fields, params={'query': search_query})
+    if search_results is None:
+        search_results = search_campaigns(search_query, fields)
+        campaign = search_results['results'][0]['campaign']
+        CACHE.register_campaign(campaign['id'], campaign.get('send_time'))
+        CACHE.set(search_results, 'search-campaigns', fields=fields, params={'query': search_query},
+                  expires_with=campaign['id'])
+    campaign = search_results['results'][0]['campaign']
+    send_times[campaign['id']] = campaign.get('send_time')
+    return campaign['id']
 
 
 @with_backoff
-def get_click_details(campaign_id):
-    report = mailchimp_client().reports.get(
-        campaign_id=campaign_id,
-        fields='opens,clicks',
-    )
+def search_campaigns(search_query, fields):
+    return mailchimp_client().search_campaigns.get(query=search_query, fields=fields)
+
+
+def get_click_details(campaign_id, fresh=False):
+    fields = 'opens,clicks'
+    if fresh:
+        report = get_report(campaign_id, fields)
+    else:
+        report = CACHE.fetch(lambda: get_report(campaign_id, fields), 'reports', campaign_id, fields)
     return {
         'open_rate': report['opens']['open_rate'],
         'click_rate': report['clicks']['click_rate'],
@@ -62,68 +348,235 @@ def get_click_details(campaign_id):
 
 
 @with_backoff
+def get_report(campaign_id, fields):
+    return mailchimp_client().reports.get(campaign_id=campaign_id, fields=fields)
+
+
 def group_links_by_url(campaign_id):
-    report = mailchimp_client().reports.click_details.all(
+    first_page = get_links_page(campaign_id, 0)
+    offsets = range(PAGE_SIZE, first_page['total_items'], PAGE_SIZE)
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        pages = [first_page, *pool.map(instrumentation.bind(lambda offset: get_links_page(campaign_id, offset)), offsets)]
+
+    url_links = defaultdict(dict)
+    for page in pages:
+        for info in page['urls_clicked']:
+            url_links[info['url']][info['id']] = info['unique_clicks']
+    return url_links
+
+
+def get_links_page(campaign_id, offset):
+    fields = 'total_items,urls_clicked.id,urls_clicked.url,urls_clicked.unique_clicks'
+    params = {'offset': offset, 'count': PAGE_SIZE}
+    return CACHE.fetch(
+        lambda: fetch_links_page(campaign_id, fields, offset), 'click-details', campaign_id, fields, params
+    )
+
+
+@with_backoff
+def fetch_links_page(campaign_id, fields, offset):
+    return mailchimp_client().reports.click_details.all(
         campaign_id=campaign_id,
-        fields='urls_clicked.id,urls_clicked.url',
-        count=500,
+        fields=fields,
+        count=PAGE_SIZE,
+        offset=offset,
     )
-    url_links = defaultdict(list)
-    for info in report['urls_clicked']:
-        url_links[info['url']].append(info['id'])
-    return url_links
 
 
-def get_clicks_by_url(campaign_id, url_link_ids):
-    url_clicks = defaultdict(lambda: {'total': 0, 'unique': set()})
-    url_batches = {}
+def get_clicks_by_url(campaign_id, url_link_ids, checkpoint=None):
+    checkpoint = checkpoint or Checkpoint(campaign_id)
+    aggregate = checkpoint.aggregate
+    link_urls = {}
+    link_pages = {}
+    covered = {}
     for url, link_ids in url_link_ids.items():
-        operations = []
-        for lid in link_ids:
-            operations.append({
-                'method': 'GET',
-                'path': f'/reports/{campaign_id}/click-details/{lid}/members',
-                'params': {'count': 500}
-            })
-        batch = create_batch({'operations': operations})
-        url_batches[url] = batch['id']
-
-    logger.debug(url_batches)
-
-    for url, batch_id in url_batches.items():
-        response = get_batch(batch_id)
-        actual_location = response['response_body_url']
-        response_info = BytesIO(requests.get(actual_location).content)
-        tfile = tarfile.open(fileobj=response_info)
-        for i in tfile.getmembers():
-            f = tfile.extractfile(i)
-            if not isinstance(f, tarfile.ExFileObject):
+        for lid, members in link_ids.items():
+            link_urls[lid] = url
+            link_pages[lid] = range(0, max(members, 1), PAGE_SIZE)
+            covered[lid] = len(link_pages[lid]) * PAGE_SIZE
+
+    def add_page(lid, info):
+        aggregate.add_page(link_urls[lid], lid, info['members'])
+        return info['total_items']
+
+    def extend_pages(totals):
+        # Members who clicked after the link list was read spill onto pages not yet requested.
+        for lid, total_items in totals.items():
+            if total_items > covered[lid]:
+                link_pages[lid] = range(covered[lid], total_items, PAGE_SIZE)
+                covered[lid] += len(link_pages[lid]) * PAGE_SIZE
+
+    @with_download_backoff
+    def process(batch):
+        # Returns the batch id, the links' member totals and the pages added to the aggregate.
+        # A download cut off partway is read again from the start; pages added the first time
+        # are not counted twice, since the aggregate skips members it already has on a link.
+        totals = {}
+        added = []
+        for operation_id, status, response in iter_batch_results(batch['response_body_url']):
+            if status != 200:
+                logger.warning(f'Batch operation {operation_id} failed: {response}')
                 continue
-            data = json.loads(f.read())
-            if len(data) > 0 and 'response' in data[0]:
-                info = json.loads(data[0]['response'])
-                for m in info['members']:
-                    url_clicks[url]['total'] += m['clicks']
-                    url_clicks[url]['unique'].add(m['email_address'])
-        url_clicks[url]['unique'] = len(url_clicks[url]['unique'])
-    logger.debug(url_clicks)
-    return url_clicks
+            lid, offset = operation_id.split('/')
+            total_items, clicks = response
+            if CACHE.enabled:
+                info = {'total_items': total_items, 'members': [{'email_address': e, 'clicks': c} for e, c in clicks]}
+                CACHE.set(info, MEMBERS_ENDPOINT, campaign_id, MEMBER_FIELDS, member_page_params(lid, int(offset)))
+            aggregate.add_clicks(link_urls[lid], lid, clicks)
+            totals[lid] = total_items
+            added.append((lid, int(offset)))
+        return batch['id'], totals, added
+
+    # Batches submitted before an interruption are polled again instead of being resubmitted.
+    resumed = list(checkpoint.pending)
+    in_flight = checkpoint.pending_pages()
+    # Pages whose batch operation failed are fetched directly in the next round; if that fails
+    # too, after its retries, so does the run.
+    failed = []
+    while link_pages or resumed or failed:
+        fetched = link_pages
+        link_pages = {}
+
+        uncached = defaultdict(list)
+        for lid, offsets in fetched.items():
+            for offset in offsets:
+                if offset in checkpoint.fetched[lid] or (lid, offset) in in_flight:
+                    continue
+                info = CACHE.get(MEMBERS_ENDPOINT, campaign_id, MEMBER_FIELDS, member_page_params(lid, offset))
+                if info is None:
+                    uncached[lid].append(offset)
+                else:
+                    extend_pages({lid: add_page(lid, info)})
+                    checkpoint.page_fetched(lid, offset)
+
+        pages = [(lid, offset) for lid, offsets in uncached.items() for offset in offsets]
+        batch_ids, resumed = resumed, []
+        direct, failed = failed, []
+        if direct:
+            logger.warning(f'Fetching {len(direct)} member page(s) that failed in a batch directly.')
+        if pages and len(pages) <= DIRECT_FETCH_MAX_PAGES:
+            logger.info(f'Fetching {len(pages)} member page(s) directly (at most {DIRECT_FETCH_MAX_PAGES}).')
+            direct, pages, uncached = direct + pages, [], {}
+        start = perf_counter()
+        if direct:
+            with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+                fetch = instrumentation.bind(lambda p: fetch_members_page(campaign_id, *p))
+                for (lid, offset), info in zip(direct, pool.map(fetch, direct)):
+                    CACHE.set(info, MEMBERS_ENDPOINT, campaign_id, MEMBER_FIELDS, member_page_params(lid, offset))
+                    extend_pages({lid: add_page(lid, info)})
+                    checkpoint.page_fetched(lid, offset)
+            checkpoint.save()
+            logger.info(f'Fetched {len(direct)} member page(s) directly in {perf_counter() - start:.2f}s.')
+        if pages:
+            start = perf_counter()
+            operations = member_operations(campaign_id, uncached)
+            for i in range(0, len(operations), MAX_BATCH_OPERATIONS):
+                chunk = operations[i:i + MAX_BATCH_OPERATIONS]
+                batch = create_batch({'operations': chunk})
+                checkpoint.batch_submitted(batch['id'], chunk)
+                batch_ids.append(batch['id'])
+            logger.info(f'Fetching {len(pages)} member page(s) in {len(batch_ids)} batch(es).')
+
+        debug(lambda: batch_ids)
+
+        if batch_ids:
+            for batch_id, totals, added in wait_for_batches(mailchimp_client(), batch_ids, process):
+                failed.extend(checkpoint.batch_processed(batch_id, added))
+                extend_pages(totals)
+            logger.info(f'Fetched {len(batch_ids)} batch(es) in {perf_counter() - start:.2f}s.')
+
+    logger.info(f'{aggregate.any_clickers()} member(s) clicked a tracked URL.')
+    debug(aggregate.as_dict)
+    try:
+        HISTORY.append(campaign_id, aggregate, send_times.get(campaign_id))
+    except Exception:
+        logger.exception(f'Could not record campaign {campaign_id} in the history.')
+    return aggregate
+
+
+def estimate_clicks_by_url(campaign_id, url_link_ids, fraction):
+    estimate = ClickEstimate()
+    link_urls = {}
+    link_pages = {}
+    for url, link_ids in url_link_ids.items():
+        for lid, members in link_ids.items():
+            link_urls[lid] = url
+            link_pages[lid] = range(0, max(members, 1), PAGE_SIZE)
+
+    def sample_link(lid, offsets):
+        members = []
+        for offset in offsets:
+            members.extend(get_members_page(campaign_id, lid, offset)['members'])
+        return lid, members
+
+    sample = sample_pages(link_pages, fraction)
+    with ThreadPoolExecutor(max_workers=PAGE_WORKERS) as pool:
+        for lid, members in pool.map(instrumentation.bind(lambda item: sample_link(*item)), sample.items()):
+            url = link_urls[lid]
+            estimate.add_link_sample(url, url_link_ids[url][lid], members)
+    debug(estimate.as_dict)
+    return estimate
+
+
+def sample_pages(link_pages, fraction, seed=0):
+    # Picks round(fraction * pages) member pages of every link, and always at least one.
+    rng = Random(seed)
+    return {
+        lid: sorted(rng.sample(offsets, max(round(len(offsets) * fraction), 1)))
+        for lid, offsets in link_pages.items()
+    }
+
+
+def get_members_page(campaign_id, link_id, offset):
+    return CACHE.fetch(
+        lambda: fetch_members_page(campaign_id, link_id, offset),
+        MEMBERS_ENDPOINT, campaign_id, MEMBER_FIELDS, member_page_params(link_id, offset),
+    )
 
 
 @with_backoff
-def create_batch(data):
-    return mailchimp_client().batches.create(data)
+def fetch_members_page(campaign_id, link_id, offset):
+    return mailchimp_client().reports.click_details.members.all(
+        campaign_id=campaign_id,
+        link_id=link_id,
+        fields=MEMBER_FIELDS,
+        count=PAGE_SIZE,
+        offset=offset,
+    )
+
+
+def member_operations(campaign_id, link_pages):
+    return [
+        {
+            'method': 'GET',
+            'path': f'/reports/{campaign_id}/click-details/{lid}/members',
+            'operation_id': f'{lid}/{offset}',
+            'params': {'count': PAGE_SIZE, 'offset': offset, 'fields': MEMBER_FIELDS},
+        }
+        for lid, offsets in link_pages.items()
+        for offset in offsets
+    ]
+
+
+def member_page_params(link_id, offset):
+    return {'link_id': link_id, 'offset': offset, 'count': PAGE_SIZE}
 
 
-@with_backoff_condition('response["response_body_url"] != ""')
-def get_batch(batch_id):
-    return mailchimp_client().batches.get(batch_id)
+@with_backoff
+def create_batch(data):
+    return mailchimp_client().batches.create(data)
 
 
 def mailchimp_client():
     global mc_client
     if mc_client is None:
-        mc_client = MailChimp(mc_api=MAILCHIMP_API_KEY)
+        client = MailChimp(mc_api=mailchimp_api_key())
+        # Every endpoint goes through _make_request, so that is where the connection limit and the
+        # pooled session are applied.
+        client._make_request = LIMITERS['mailchimp'].wrap(transport.request)
+        if MAILCHIMP_URL:
+            client.base_url = MAILCHIMP_URL
+        mc_client = client
     return mc_client
 
 
@@ -133,11 +586,15 @@ def get_url_click_rates(url_details, overall_details):
             'click_rate': d['total']/overall_details['total_clicks'],
             'unique_click_rate': d['unique']/overall_details['unique_clicks'],
         }
-        for u, d in url_details.items()
+        for u, d in url_details.as_dict().items()
     }
-    logger.debug(data)
+    debug(lambda: data)
     return data
 
 
 if __name__ == '__main__':
-    main()
+    instrumentation.start()
+    try:
+        instrumentation.profiled(main)
+    finally:
+        instrumentation.write_summary()
@@ -0,0 +1,60 @@
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import perf_counter
+from utils import logger
+import instrumentation
+
+PIPELINE_WORKERS = 4
+
+
+class Pipeline:
+    # Runs named stages on a thread pool, each as soon as the stages it depends on have finished.
+    # A stage's function is called with the results of its dependencies, in the order listed.
+
+    def __init__(self, workers=PIPELINE_WORKERS):
+        self.workers = workers
+        self.timings = {}
+        self._stages = {}
+
+    def stage(self, name, func, *dependencies):
+        for dependency in dependencies:
+            if dependency not in self._stages:
+                raise KeyError(f'Stage {repr(name)} depends on unknown stage {repr(dependency)}.')
+        self._stages[name] = (func, dependencies)
+
+    def run(self):
+        results = {}
+        finished_at = {}
+        started = perf_counter()
+        waiting = dict(self._stages)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while waiting or running:
+                for name, (func, dependencies) in list(waiting.items()):
+                    if all(d in results for d in dependencies):
+                        del waiting[name]
+                        args = [results[d] for d in dependencies]
+                        running[pool.submit(instrumentation.bind(self._timed), name, func, args)] = name
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception:
+                        for pending in running:
+                            pending.cancel()
+                        raise
+                    finished_at[name] = perf_counter() - started
+
+        longest = max(finished_at.values(), default=0)
+        for name, seconds in self.timings.items():
+            logger.info(f'Stage {name}: {seconds:.2f}s (finished at {finished_at[name]:.2f}s)')
+        logger.info(f'Pipeline finished in {longest:.2f}s; stages took {sum(self.timings.values()):.2f}s in total.')
+        return results
+
+    def _timed(self, name, func, args):
+        start = perf_counter()
+        try:
+            with instrumentation.span(name, 'stage'):
+                return func(*args)
+        finally:
+            self.timings[name] = perf_counter() - start
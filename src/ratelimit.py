@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+from functools import wraps
+from threading import BoundedSemaphore, Lock
+from time import monotonic, perf_counter, sleep
+from utils import logger
+
+
+class TokenBucket:
+    # Allows per_minute acquisitions per minute on average, in bursts of up to burst.
+
+    def __init__(self, per_minute, burst=None):
+        self.rate = per_minute / 60
+        self.capacity = burst or max(per_minute // 6, 1)
+        self._tokens = self.capacity
+        self._updated = monotonic()
+        self._lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                shortfall = (1 - self._tokens) / self.rate
+            sleep(shortfall)
+
+
+class RateLimiter:
+    # Bounds a service's concurrent connections and its requests per minute, and records how
+    # long calls wait on the limiter separately from how long the calls themselves take.
+
+    def __init__(self, name, concurrency=None, per_minute=None):
+        self.name = name
+        self.concurrency = concurrency
+        self._semaphore = BoundedSemaphore(concurrency) if concurrency else None
+        self._bucket = TokenBucket(per_minute) if per_minute else None
+        self._lock = Lock()
+        self.calls = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.busy = 0.0
+
+    @contextmanager
+    def limit(self):
+        start = perf_counter()
+        if self._bucket:
+            self._bucket.acquire()
+        if self._semaphore:
+            self._semaphore.acquire()
+        acquired = perf_counter()
+        try:
+            yield
+        finally:
+            if self._semaphore:
+                self._semaphore.release()
+            with self._lock:
+                self.calls += 1
+                self.waited += acquired - start
+                self.max_wait = max(self.max_wait, acquired - start)
+                self.busy += perf_counter() - acquired
+
+    def wrap(self, func):
+        @wraps(func)
+        def limited(*args, **kwargs):
+            with self.limit():
+                return func(*args, **kwargs)
+        return limited
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'waited': self.waited, 'max_wait': self.max_wait, 'busy': self.busy}
+
+
+# Mailchimp allows 10 simultaneous connections per API key; Sheets allows 60 reads and 60 writes
+# per minute per user.
+MAX_CONNECTIONS = 10
+LIMITERS = {
+    'mailchimp': RateLimiter('mailchimp', concurrency=MAX_CONNECTIONS),
+    'sheets-read': RateLimiter('sheets-read', concurrency=MAX_CONNECTIONS, per_minute=60),
+    'sheets-write': RateLimiter('sheets-write', concurrency=MAX_CONNECTIONS, per_minute=60),
+    'drive': RateLimiter('drive', concurrency=MAX_CONNECTIONS, per_minute=600),
+}
+
+
+# The limiters whose calls share each Google API client's connection pool.
+API_LIMITERS = {'sheets': ('sheets-read', 'sheets-write'), 'drive': ('drive',)}
+
+
+def pool_size(*names):
+    # The connections a pool shared by these limiters needs so that no call they admit waits for one.
+    return sum(LIMITERS[name].concurrency for name in names)
+
+
+def google_limiter(request):
+    if not request.methodId.startswith('sheets.'):
+        return LIMITERS['drive']
+    return LIMITERS['sheets-read' if request.method == 'GET' else 'sheets-write']
+
+
+def log_limiter_stats():
+    for name, limiter in LIMITERS.items():
+        stats = limiter.stats()
+        if stats['calls']:
+            logger.info(
+                f'{name}: {stats["calls"]} call(s), {stats["waited"]:.2f}s waiting on the limiter '
+                f'(max {stats["max_wait"]:.2f}s), {stats["busy"]:.2f}s in calls.'
+            )
@@ -0,0 +1,207 @@
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
+from functools import wraps
+from itertools import count
+from threading import Lock
+from time import monotonic, sleep
+import os
+import random
+import requests
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from utils import logger
+import instrumentation
+
+RETRYABLE_STATUSES = frozenset({429, 500, 502, 503, 504})
+# A run gives up once this many seconds have passed, instead of hanging until Fargate kills it.
+# Watch mode and backfills start the budget over for every refresh and campaign.
+RUN_DEADLINE = float(os.environ.get('INSIGHT_RUN_DEADLINE', 45 * 60))
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryError(Exception):
+    pass
+
+
+class Deadline:
+    def __init__(self, seconds=None):
+        self.restart(seconds)
+
+    def restart(self, seconds=None):
+        self.expires = None if seconds is None else monotonic() + seconds
+
+    def remaining(self):
+        if self.expires is None:
+            return float('inf')
+        return max(self.expires - monotonic(), 0)
+
+    def expired(self):
+        return self.remaining() == 0
+
+
+# Unlimited until start_run() is called, so importing the module never starts the clock.
+RUN_BUDGET = Deadline()
+
+
+def start_run(seconds=RUN_DEADLINE):
+    RUN_BUDGET.restart(seconds)
+
+
+def error_status(exc):
+    # Returns the HTTP status and headers carried by a requests, mailchimp3 or googleapiclient error.
+    response = getattr(exc, 'response', None)
+    if isinstance(exc, requests.HTTPError) and response is not None:
+        return response.status_code, response.headers
+    resp = getattr(exc, 'resp', None)
+    if resp is not None and hasattr(resp, 'status'):
+        return int(resp.status), resp
+    if type(exc).__name__ == 'MailChimpError' and exc.args and isinstance(exc.args[0], dict):
+        data = exc.args[0]
+        if isinstance(data.get('response'), requests.Response):
+            return data['response'].status_code, data['response'].headers
+        return data.get('status'), {}
+    return None, {}
+
+
+def is_retryable(exc):
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    status, _ = error_status(exc)
+    return status in RETRYABLE_STATUSES
+
+
+def is_retryable_download(exc):
+    # Reading a streamed response's raw body bypasses requests, so a connection dropped partway
+    # through surfaces as urllib3's own errors.
+    return is_retryable(exc) or isinstance(exc, (ProtocolError, ReadTimeoutError))
+
+
+def is_outage(exc):
+    # Whether a retryable error points at an endpoint that is down rather than one that is busy:
+    # connection failures and 5xx responses count, throttling and anything sent with a
+    # Retry-After do not.
+    if isinstance(exc, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)):
+        return True
+    status, _ = error_status(exc)
+    return status is not None and status >= 500 and retry_after(exc) is None
+
+
+def retry_after(exc):
+    # Returns the seconds the server asked us to wait, if it sent a Retry-After header.
+    _, headers = error_status(exc)
+    value = headers.get('Retry-After') or headers.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    # Opens after failure_threshold consecutive outages (see is_outage), failing new calls fast
+    # until reset_timeout has passed; the next call then probes the endpoint again. Calls already
+    # retrying when it opens keep their remaining attempts.
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=60):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._lock = Lock()
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is not None and monotonic() - self._opened_at < self.reset_timeout:
+                raise CircuitOpenError(f'The {self.name} circuit is open after {self._failures} consecutive failures.')
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f'Opening the {self.name} circuit for {self.reset_timeout} seconds.')
+                self._opened_at = monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+
+class RetryPolicy:
+    # Retries a call with full-jitter exponential backoff, capped per sleep, per call (deadline)
+    # and per run (budget). retry_if decides which exceptions are retried, and until, if given,
+    # which results are accepted. A server's Retry-After always takes precedence over the backoff.
+    # With a span_kind, each call is recorded as a span of that kind, retries included.
+
+    def __init__(self, max_attempts=8, base=1, cap=60, deadline=600, retry_if=is_retryable, until=None,
+                 breaker=None, budget=RUN_BUDGET, span_kind=None):
+        self.max_attempts = max_attempts
+        self.base = base
+        self.cap = cap
+        self.deadline = deadline
+        self.retry_if = retry_if
+        self.until = until
+        self.breaker = breaker
+        self.budget = budget
+        self.span_kind = span_kind
+
+    def __call__(self, func):
+        @wraps(func)
+        def call(*args, **kwargs):
+            return self.call(func, *args, **kwargs)
+        return call
+
+    def call(self, func, *args, **kwargs):
+        if self.span_kind is None:
+            return self._call(func, *args, **kwargs)
+        with instrumentation.span(func.__name__, self.span_kind):
+            return self._call(func, *args, **kwargs)
+
+    def _call(self, func, *args, **kwargs):
+        deadline = Deadline(self.deadline)
+        for attempt in count(1):
+            error = None
+            if self.breaker and attempt == 1:
+                self.breaker.before_call()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self.retry_if(e):
+                    raise
+                if self.breaker and is_outage(e):
+                    self.breaker.record_failure()
+                error = e
+            else:
+                if self.breaker:
+                    self.breaker.record_success()
+                if self.until is None or self.until(result):
+                    return result
+
+            delay = retry_after(error) if error is not None else None
+            if delay is None:
+                delay = random.uniform(0, min(self.cap, self.base * 2 ** attempt))
+            if attempt >= self.max_attempts or delay > min(deadline.remaining(), self.budget.remaining()):
+                if error is not None:
+                    raise error
+                raise RetryError(f'{func.__name__} gave no acceptable result after {attempt} attempt(s).')
+            logger.info(f'Retrying {func.__name__} in {delay:.1f} seconds.')
+            instrumentation.add_retry()
+            sleep(delay)
+
+
+MAILCHIMP_BREAKER = CircuitBreaker('mailchimp')
+GOOGLE_BREAKER = CircuitBreaker('google')
+
+with_backoff = RetryPolicy(breaker=MAILCHIMP_BREAKER, span_kind='mailchimp')
+with_google_backoff = RetryPolicy(breaker=GOOGLE_BREAKER)
+# Batch results are served from storage rather than the API, so they don't trip its breaker.
+with_download_backoff = RetryPolicy(max_attempts=4, retry_if=is_retryable_download)
@@ -0,0 +1,47 @@
+from hashlib import blake2b
+from math import log, sqrt
+
+DEFAULT_PRECISION = 12
+
+
+class HyperLogLog:
+    # Estimates the number of distinct values added to it in a fixed 2**precision bytes.
+    # Sketches with the same precision can be merged, the result estimating their union.
+
+    def __init__(self, precision=DEFAULT_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        digest = blake2b(value.encode(), digest_size=8).digest()
+        h = int.from_bytes(digest, 'big')
+        width = 64 - self.precision
+        index = h >> width
+        rank = width - (h & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f'Cannot merge sketches of precision {self.precision} and {other.precision}.')
+        self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def __or__(self, other):
+        result = HyperLogLog(self.precision)
+        result.registers[:] = self.registers
+        return result.merge(other)
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            return m * log(m / zeros)
+        return estimate
+
+    @property
+    def error(self):
+        # The relative standard error of count().
+        return 1.04 / sqrt(len(self.registers))
@@ -10,6 +10,8 @@ MOUNTAIN: Represents the Mountain timezone for locations that observe DST.
 CENTRAL: Represents the Central timezone.
 EASTERN: Represents the Eastern timezone.
 LOCAL: References the local timezone.
+
+Each timezone also converts arrays of UTC epoch seconds in bulk with to_local(), which needs NumPy.
 """
 
 import datetime as _dt
@@ -31,6 +33,13 @@ class _FixedTimezone(_dt.tzinfo):
     def tzname(self, dt):
         return self._name
 
+    def to_local(self, epochs):
+        # Returns the local wall times (datetime64[s]) and UTC offsets in seconds for UTC epoch seconds.
+        import numpy as np
+        epochs = np.asarray(epochs, dtype='int64')
+        offsets = np.full(epochs.shape, self._offset * 3600, dtype='int64')
+        return (epochs + offsets).astype('datetime64[s]'), offsets
+
     def __repr__(self):
         return self._name
 
@@ -44,23 +53,33 @@ class _DstTimezone(_dt.tzinfo):
         self._std_name = std_on[0]
         self._dst_on = dst_on[1:]
         self._dst_end = std_on[1:]
+        self._transitions = {}
 
     @staticmethod
     def _find_date(year, month, week, day,  hour=0, minute=0):
         result = _dt.datetime(year, month, 7 * week, hour, minute)
-        for i in range(6):
+        for i in range(7):
             if result.weekday() == day:
                 return result
             result -= _dt.timedelta(days=1)
 
+    def _year_transitions(self, year):
+        # The local wall times at which DST starts and ends in the year, computed once per year.
+        try:
+            return self._transitions[year]
+        except KeyError:
+            transitions = self._transitions[year] = (
+                self._find_date(year, *self._dst_on), self._find_date(year, *self._dst_end)
+            )
+            return transitions
+
     def utcoffset(self, dt):
         return _dt.timedelta(hours=self._offset) + self.dst(dt)
 
     def dst(self, dt):
         if dt is None:
             return _dt.timedelta(hours=0)
-        start = self._find_date(dt.year, *self._dst_on)
-        end = self._find_date(dt.year, *self._dst_end)
+        start, end = self._year_transitions(dt.year)
 
         if start <= dt.replace(tzinfo=None) < end:
             return _dt.timedelta(hours=1)
@@ -73,10 +92,33 @@ class _DstTimezone(_dt.tzinfo):
         else:
             return self._std_name
 
+    def to_local(self, epochs):
+        # Returns the local wall times (datetime64[s]) and UTC offsets in seconds for UTC epoch seconds.
+        # Wall times match datetime.fromtimestamp(epoch, tz); offsets are also right in the hour that
+        # repeats when DST ends, which the datetime's own utcoffset() cannot tell apart.
+        import numpy as np
+        epochs = np.asarray(epochs, dtype='int64')
+        std_offset = self._offset * 3600
+        offsets = np.full(epochs.shape, std_offset, dtype='int64')
+        if epochs.size:
+            years = (epochs + std_offset).astype('datetime64[s]').astype('datetime64[Y]').astype('int64') + 1970
+            # DST applies from its start until its end, both read on the standard-time clock, so an
+            # epoch is in DST exactly when it falls after an odd number of the sorted UTC instants.
+            table = np.array([
+                (transition - _EPOCH).total_seconds() - std_offset
+                for year in range(years.min(), years.max() + 1)
+                for transition in self._year_transitions(int(year))
+            ], dtype='int64')
+            offsets += 3600 * (np.searchsorted(table, epochs, side='right') % 2)
+        return (epochs + offsets).astype('datetime64[s]'), offsets
+
     def __repr__(self):
         return f'{self._dst_name}/{self._std_name}'
 
 
+_EPOCH = _dt.datetime(1970, 1, 1)
+
+
 # Timezones Objects
 UNIVERSAL = _FixedTimezone(0, 'UTC')
 HAWAII = _FixedTimezone(-10, 'HAST')
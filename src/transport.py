@@ -0,0 +1,97 @@
+from threading import Lock
+from urllib.parse import urlsplit
+import os
+import requests
+from requests.adapters import HTTPAdapter
+from ratelimit import LIMITERS
+from utils import logger
+import instrumentation
+
+CONNECT_TIMEOUT = float(os.environ.get('INSIGHT_CONNECT_TIMEOUT', 5))
+READ_TIMEOUT = float(os.environ.get('INSIGHT_READ_TIMEOUT', 60))
+# The pools block once every connection to a host is busy, so each is sized to all the calls the
+# limiters in front of it admit at once: Mailchimp's here, and for Google, those of every limiter
+# sharing a client, so the Sheets client's pool holds both the read and the write limiter's.
+POOL_SIZE = LIMITERS['mailchimp'].concurrency
+
+
+class PooledAdapter(HTTPAdapter):
+    # Keeps up to pool_size connections alive per host, blocking rather than opening extra ones,
+    # and applies the default timeouts to any request that doesn't set its own.
+
+    def __init__(self, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), pool_size=POOL_SIZE):
+        self.timeout = timeout
+        super().__init__(pool_connections=4, pool_maxsize=pool_size, pool_block=True)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def mount(session, pool_size=POOL_SIZE):
+    adapter = PooledAdapter(pool_size=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip'
+    return session
+
+
+_sessions = {}
+_sessions_lock = Lock()
+
+
+def session_for(url):
+    # Returns the keep-alive session shared by every request to the URL's host.
+    host = urlsplit(url).netloc
+    with _sessions_lock:
+        if host not in _sessions:
+            _sessions[host] = mount(requests.Session())
+        return _sessions[host]
+
+
+def request(**kwargs):
+    # A drop-in for mailchimp3's MailChimpClient._make_request.
+    response = session_for(kwargs['url']).request(**kwargs)
+    instrumentation.add_bytes(len(response.content))
+    return response
+
+
+class AuthorizedHttp:
+    # An httplib2.Http look-alike for googleapiclient that sends requests through a pooled
+    # AuthorizedSession, which unlike httplib2.Http can be shared between threads.
+
+    def __init__(self, credentials, pool_size=POOL_SIZE):
+        from google.auth.transport.requests import AuthorizedSession
+        self.session = mount(AuthorizedSession(credentials), pool_size)
+        with _sessions_lock:
+            _sessions['google'] = self.session
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        import httplib2
+        response = self.session.request(method, uri, data=body, headers=headers)
+        instrumentation.add_bytes(len(response.content))
+        # requests has already decoded the body, so googleapiclient must not try again.
+        headers = {k: v for k, v in response.headers.items() if k.lower() != 'content-encoding'}
+        resp = httplib2.Response({**headers, 'status': str(response.status_code)})
+        resp.reason = response.reason
+        return resp, response.content
+
+
+def connection_stats():
+    # Returns {host: (requests, connections)}; fewer connections than requests means reused TLS sessions.
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.values())
+    for session in sessions:
+        pools = session.get_adapter('https://').poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            requests_, connections = stats.get(pool.host, (0, 0))
+            stats[pool.host] = (requests_ + pool.num_requests, connections + pool.num_connections)
+    return stats
+
+
+def log_connection_stats():
+    for host, (requests_, connections) in connection_stats().items():
+        logger.info(f'{host}: {requests_} request(s) over {connections} connection(s).')
@@ -1,53 +1,35 @@
-from time import sleep
 from functools import wraps
+from threading import Lock
 import logging
-import requests
+import os
 
 
 # setup logger
 logger = logging.getLogger()
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
+logger.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
 handler = logging.StreamHandler()
 handler.setLevel(logging.DEBUG)
 logger.addHandler(handler)
 
 
-# Configure requests for exponential backoff
-DEFAULT_TIMEOUT = 10
-old_send = requests.Session.send
+def debug(message):
+    # Logs message() at DEBUG, only building the message when DEBUG is enabled.
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(message())
 
 
-def new_send(*args, **kwargs):
-    if kwargs.get("timeout", None) is None:
-        kwargs["timeout"] = DEFAULT_TIMEOUT
-    return old_send(*args, **kwargs)
+def lazy(func):
+    # Defers func until its result is first needed, then returns that same result every time.
+    lock = Lock()
+    result = []
 
-
-requests.Session.send = new_send
-
-
-def with_backoff(func):
-    return with_backoff_condition('True')(func)
-
-
-def with_backoff_condition(condition):
-    def backoff(func):
-        @wraps(func)
-        def try_request(*args, **kwargs):
-            backoff = 5
-            response = None
-            while True:
-                try:
-                    response = func(*args, **kwargs)
-                    if eval(condition):
-                        break
-                except requests.exceptions.ConnectTimeout:
-                    pass
-                logger.info(f'Retrying request in {backoff} seconds.')
-                sleep(backoff)
-                backoff *= 2
-            return response
-        return try_request
-    return backoff
+    @wraps(func)
+    def get():
+        if not result:
+            with lock:
+                if not result:
+                    result.append(func())
+        return result[0]
+    return get
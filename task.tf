@@ -30,7 +30,7 @@ module "fargate_scheduled_task" {
 data "aws_iam_policy_document" "default" {
   statement {
     effect    = "Allow"
-    actions   = ["ssm:GetParameter"]
+    actions   = ["ssm:GetParameters"]
     resources = ["arn:aws:ssm:*:${data.aws_caller_identity.current.account_id}:parameter/insight-analytics/*"]
   }
 }
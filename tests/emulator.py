@@ -0,0 +1,666 @@
+"""A local HTTP emulator of the Mailchimp, Sheets, Drive and SSM endpoints the task calls.
+
+Unlike mockchimp3 and mock_sheet, it is reached over real HTTP, so the whole I/O path of main()
+runs against it: SSM secrets, the Google token exchange and discovery documents, Drive copies,
+listings and deletes, Sheets batchUpdate, values.batchUpdate and values.batchGet, and Mailchimp
+search, reports, click details, member pages, email activity and batches whose tarball is only
+ready after a delay. Campaigns are generated deterministically for whatever title is searched for, and
+click() adds clicks to one as they would arrive after the send.
+
+Latency, jitter, random 429s, failed batch operations, broken downloads and per-service limits (Mailchimp
+connections, Sheets reads and writes per minute) can be injected to measure retries, concurrency
+and wall time.
+
+    python tests/emulator.py [--port 8080] [--latency 0.05] [--jitter 0.02] [--error-rate 0.01]
+
+prints the environment variables that point the task at it.
+"""
+from argparse import ArgumentParser
+from collections import defaultdict, deque
+from copy import deepcopy
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from threading import Lock, Thread
+from time import monotonic, sleep
+from urllib.parse import urlsplit, parse_qs
+import datetime
+import io
+import json
+import os
+import re
+import sys
+import tarfile
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from google_sheet import (
+    METRICS_SPREADSHEET_TEMPLATE, GOOGLE_SA_PARAMETER, MAILCHIMP_API_KEY_PARAMETER, SPREADSHEET_MIME_TYPE,
+)
+
+TEMPLATE_SHEETS = ['Master', 'First Friday', 'Second Friday', 'Third Friday', 'Fourth Friday', 'Fifth Friday']
+RESULTS_PER_FILE = 50
+MAILCHIMP_API_KEY = '0123456789abcdef0123456789abcdef-us1'
+# Set by a route on its response headers to have the handler cut the body short.
+TRUNCATE_HEADER = 'X-Emulator-Truncate'
+
+
+class Emulator:
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, jitter=0.0, error_rate=0.0,
+                 mailchimp_connections=10, sheets_reads_per_minute=None, sheets_writes_per_minute=None,
+                 batch_delay=1.0, failed_operations=0, broken_downloads=0, links=10, urls=None, members=2000, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.mailchimp_connections = mailchimp_connections
+        self.quotas = {'sheets-read': sheets_reads_per_minute, 'sheets-write': sheets_writes_per_minute}
+        self.batch_delay = batch_delay
+        # The first this many batch operations served come back with a 500 status.
+        self.failed_operations = failed_operations
+        # The first this many batch result downloads are cut off halfway through the archive.
+        self.broken_downloads = broken_downloads
+        self.links = links
+        self.urls = urls or max(links // 2, 1)
+        self.members = members
+        self.requests = defaultdict(int)
+        self.throttled = defaultdict(int)
+        # The most admitted API calls that were being served at once.
+        self.peak_active = 0
+        self._rng = Random(seed)
+        self._lock = Lock()
+        self._in_flight = 0
+        self._active = 0
+        self._calls = defaultdict(deque)
+        self._campaigns = {}
+        self._activity = defaultdict(list)
+        self._batches = {}
+        self._files = {}
+        self._spreadsheets = {}
+        self._private_key = None
+        self._add_template()
+        handler = type('Handler', (EmulatorHandler,), {'emulator': self})
+        self.server = ThreadingHTTPServer((host, port), handler)
+        self.server.daemon_threads = True
+        self.url = f'http://{host}:{self.server.server_port}'
+
+    def start(self):
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def env(self):
+        # The variables that point the task at this emulator.
+        return {
+            'INSIGHT_MAILCHIMP_URL': f'{self.url}/3.0/',
+            'INSIGHT_DISCOVERY_URL': f'{self.url}/discovery/v1/apis/{{api}}/{{apiVersion}}/rest',
+            'INSIGHT_SSM_ENDPOINT': self.url,
+            'AWS_ACCESS_KEY_ID': 'emulator',
+            'AWS_SECRET_ACCESS_KEY': 'emulator',
+        }
+
+    # Dispatch
+
+    def handle(self, method, path, query, body, headers):
+        if method == 'POST' and 'X-Amz-Target' in headers:
+            return self._ssm(headers['X-Amz-Target'], json.loads(body))
+        for route_method, pattern, service, func in ROUTES:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                break
+        else:
+            return 404, {'error': {'code': 404, 'message': f'No route for {method} {path}'}}
+
+        if service is None:
+            return _response(func(self, *match.groups(), query=query, body=body))
+        throttled = self._admit(service)
+        if throttled:
+            return throttled
+        try:
+            delay = self.latency + self._rng.uniform(-self.jitter, self.jitter)
+            sleep(max(delay, 0))
+            return _response(func(self, *match.groups(), query=query, body=body))
+        finally:
+            with self._lock:
+                self._active -= 1
+                if service == 'mailchimp':
+                    self._in_flight -= 1
+
+    def _admit(self, service):
+        # Returns a 429 response if the call is throttled, counting admitted Mailchimp calls in flight.
+        with self._lock:
+            self.requests[service] += 1
+            now = monotonic()
+            calls = self._calls[service]
+            while calls and calls[0] <= now - 60:
+                calls.popleft()
+            quota = self.quotas.get(service)
+            if self._rng.random() < self.error_rate:
+                reason = 'injected'
+            elif service == 'mailchimp' and self._in_flight >= self.mailchimp_connections:
+                reason = 'connections'
+            elif quota is not None and len(calls) >= quota:
+                reason = 'quota'
+            else:
+                calls.append(now)
+                self._active += 1
+                self.peak_active = max(self.peak_active, self._active)
+                if service == 'mailchimp':
+                    self._in_flight += 1
+                return None
+            self.throttled[service] += 1
+        if service == 'mailchimp':
+            return 429, {'status': 429, 'title': 'Too Many Requests', 'detail': reason}, {'Retry-After': '0'}
+        return 429, {'error': {'code': 429, 'message': f'Quota exceeded ({reason})', 'status': 'RESOURCE_EXHAUSTED'}}
+
+    # Secrets and Google auth
+
+    def _ssm(self, target, request):
+        if not target.endswith('.GetParameters'):
+            return 400, {'__type': 'InvalidAction'}
+        values = {GOOGLE_SA_PARAMETER: json.dumps(self._service_account()), MAILCHIMP_API_KEY_PARAMETER: MAILCHIMP_API_KEY}
+        return 200, {
+            'Parameters': [{'Name': n, 'Value': values[n], 'Type': 'SecureString'} for n in request['Names'] if n in values],
+            'InvalidParameters': [n for n in request['Names'] if n not in values],
+        }
+
+    def _service_account(self):
+        with self._lock:
+            if self._private_key is None:
+                from cryptography.hazmat.primitives import serialization
+                from cryptography.hazmat.primitives.asymmetric import rsa
+                self._private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+                    serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption(),
+                ).decode()
+        return {
+            'type': 'service_account',
+            'project_id': 'emulator',
+            'private_key_id': 'emulator',
+            'private_key': self._private_key,
+            'client_email': 'task@emulator.iam.gserviceaccount.com',
+            'client_id': '0',
+            'token_uri': f'{self.url}/token',
+        }
+
+    def token(self, query, body):
+        return {'access_token': 'emulated', 'expires_in': 3600, 'token_type': 'Bearer'}
+
+    def discovery(self, api, version, query, body):
+        if (api, version) not in DISCOVERY:
+            return 404, {'error': {'code': 404, 'message': f'Unknown API {api} {version}'}}
+        return {**DISCOVERY[api, version], 'rootUrl': f'{self.url}/'}
+
+    # Mailchimp
+
+    def _campaign(self, campaign_id):
+        # Generates a campaign's links and clickers the first time it is asked for.
+        with self._lock:
+            if campaign_id in self._campaigns:
+                return self._campaigns[campaign_id]
+        rng = Random(campaign_id)
+        pool = [f'member{i}@example.com' for i in range(2 * self.members)]
+        links = []
+        for i in range(self.links):
+            clickers = rng.sample(pool, self.members)
+            links.append({
+                'id': f'{i:010x}',
+                'url': f'https://example.com/article-{i % self.urls}',
+                'members': [{'email_address': e, 'clicks': 1 + int(rng.expovariate(1))} for e in clickers],
+            })
+        with self._lock:
+            return self._campaigns.setdefault(campaign_id, {l['id']: l for l in links})
+
+    def click(self, campaign_id, link_id, email, clicks=1):
+        # Records new clicks on a link, in its members and as email activity stamped now.
+        link = self._campaign(campaign_id)[link_id]
+        timestamp = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        with self._lock:
+            member = next((m for m in link['members'] if m['email_address'] == email), None)
+            if member is None:
+                member = {'email_address': email, 'clicks': 0}
+                link['members'].append(member)
+            member['clicks'] += clicks
+            self._activity[campaign_id].extend(
+                {'email_address': email, 'action': 'click', 'timestamp': timestamp, 'url': link['url']}
+                for _ in range(clicks)
+            )
+
+    def search_campaigns(self, query, body):
+        title = query['query'][0]
+        campaign_id = sha1(title.encode()).hexdigest()[:10]
+        send_time = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)).isoformat()
+        return {'results': [{'campaign': {'id': campaign_id, 'send_time': send_time, 'settings': {'title': title}}}]}
+
+    def report(self, campaign_id, query, body):
+        links = self._campaign(campaign_id).values()
+        clicks_total = sum(m['clicks'] for l in links for m in l['members'])
+        unique_clicks = len({m['email_address'] for l in links for m in l['members']})
+        return {
+            'id': campaign_id,
+            'opens': {'open_rate': 0.5},
+            'clicks': {'click_rate': unique_clicks / (4 * self.members), 'clicks_total': clicks_total,
+                       'unique_clicks': unique_clicks},
+        }
+
+    def click_details(self, campaign_id, query, body):
+        links = list(self._campaign(campaign_id).values())
+        count, offset = _page(query)
+        return {
+            'total_items': len(links),
+            'urls_clicked': [
+                {'id': l['id'], 'url': l['url'], 'unique_clicks': len(l['members']),
+                 'total_clicks': sum(m['clicks'] for m in l['members'])}
+                for l in links[offset:offset + count]
+            ],
+        }
+
+    def link_members(self, campaign_id, link_id, query, body):
+        link = self._campaign(campaign_id).get(link_id)
+        if link is None:
+            return 404, {'status': 404, 'title': 'Resource Not Found'}
+        count, offset = _page(query)
+        return {'total_items': len(link['members']), 'members': link['members'][offset:offset + count]}
+
+    def email_activity(self, campaign_id, query, body):
+        since = query.get('since', [None])[0]
+        since = since and datetime.datetime.fromisoformat(since)
+        emails = defaultdict(list)
+        with self._lock:
+            for event in self._activity[campaign_id]:
+                if not since or datetime.datetime.fromisoformat(event['timestamp']) > since:
+                    emails[event['email_address']].append({k: event[k] for k in ('action', 'timestamp', 'url')})
+        count, offset = _page(query)
+        emails = [{'email_address': e, 'activity': a} for e, a in emails.items()]
+        return {'emails': emails[offset:offset + count], 'total_items': len(emails)}
+
+    def create_batch(self, query, body):
+        batch_id = uuid.uuid4().hex[:10]
+        with self._lock:
+            self._batches[batch_id] = {'operations': json.loads(body)['operations'], 'created': monotonic()}
+        return self._batch_status(batch_id)
+
+    def list_batches(self, query, body):
+        with self._lock:
+            batch_ids = list(self._batches)
+        return {'batches': [self._batch_status(b) for b in batch_ids], 'total_items': len(batch_ids)}
+
+    def get_batch(self, batch_id, query, body):
+        if batch_id not in self._batches:
+            return 404, {'status': 404, 'title': 'Resource Not Found'}
+        return self._batch_status(batch_id)
+
+    def _batch_status(self, batch_id):
+        batch = self._batches[batch_id]
+        total = len(batch['operations'])
+        progress = min((monotonic() - batch['created']) / self.batch_delay, 1) if self.batch_delay else 1
+        finished = progress == 1
+        return {
+            'id': batch_id,
+            'status': 'finished' if finished else 'started',
+            'total_operations': total,
+            'finished_operations': int(total * progress),
+            'errored_operations': 0,
+            'response_body_url': f'{self.url}/batch-results/{batch_id}.tar.gz' if finished else '',
+        }
+
+    def batch_results(self, batch_id, query, body):
+        results = []
+        for op in self._batches[batch_id]['operations']:
+            match = re.fullmatch(r'/reports/([^/]+)/click-details/([^/]+)/members', op['path'])
+            params = {k: [str(v)] for k, v in op.get('params', {}).items()}
+            status, response = 200, self.link_members(*match.groups(), query=params, body=b'')
+            if isinstance(response, tuple):
+                status, response = response
+            with self._lock:
+                if self.failed_operations:
+                    self.failed_operations -= 1
+                    status, response = 500, {'status': 500, 'title': 'Internal Server Error'}
+            results.append({'status_code': status, 'operation_id': op['operation_id'], 'response': json.dumps(response)})
+
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode='w:gz') as archive:
+            for i in range(0, len(results), RESULTS_PER_FILE):
+                content = json.dumps(results[i:i + RESULTS_PER_FILE]).encode()
+                info = tarfile.TarInfo(f'{batch_id}/{i // RESULTS_PER_FILE}.json')
+                info.size = len(content)
+                archive.addfile(info, io.BytesIO(content))
+        headers = {'Content-Type': 'application/x-gzip'}
+        with self._lock:
+            if self.broken_downloads:
+                self.broken_downloads -= 1
+                headers[TRUNCATE_HEADER] = '1'
+        return 200, buffer.getvalue(), headers
+
+    # Drive
+
+    def _add_template(self):
+        self._files[METRICS_SPREADSHEET_TEMPLATE] = {
+            'id': METRICS_SPREADSHEET_TEMPLATE, 'name': 'Template', 'mimeType': SPREADSHEET_MIME_TYPE,
+            'parents': ['emulator-folder'], 'trashed': False,
+        }
+        self._spreadsheets[METRICS_SPREADSHEET_TEMPLATE] = {
+            i: {'title': title, 'cells': {}} for i, title in enumerate(TEMPLATE_SHEETS)
+        }
+
+    def get_file(self, file_id, query, body):
+        if file_id not in self._files:
+            return 404, {'error': {'code': 404, 'message': f'File not found: {file_id}.'}}
+        return self._files[file_id]
+
+    def list_files(self, query, body):
+        parent = re.search(r"'([^']+)' in parents", query.get('q', [''])[0])
+        name = re.search(r"name = '([^']+)'", query.get('q', [''])[0])
+        with self._lock:
+            files = [
+                f for f in self._files.values()
+                if not f['trashed'] and (not parent or parent[1] in f.get('parents', []))
+                and (not name or name[1] == f['name'])
+            ]
+        page_size = int(query.get('pageSize', ['100'])[0])
+        start = int(query.get('pageToken', ['0'])[0])
+        response = {'files': [{'id': f['id'], 'name': f['name']} for f in files[start:start + page_size]]}
+        if start + page_size < len(files):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def copy_file(self, file_id, query, body):
+        if file_id not in self._files:
+            return 404, {'error': {'code': 404, 'message': f'File not found: {file_id}.'}}
+        copy_id = uuid.uuid4().hex
+        with self._lock:
+            # Like Drive, the copy lands in the original's folder.
+            self._files[copy_id] = {**deepcopy(self._files[file_id]), 'id': copy_id, 'name': json.loads(body)['name']}
+            self._spreadsheets[copy_id] = deepcopy(self._spreadsheets[file_id])
+        return {'id': copy_id, 'name': self._files[copy_id]['name']}
+
+    def delete_file(self, file_id, query, body):
+        with self._lock:
+            if self._files.pop(file_id, None) is None:
+                return 404, {'error': {'code': 404, 'message': f'File not found: {file_id}.'}}
+            self._spreadsheets.pop(file_id, None)
+        return 204, b''
+
+    # Sheets
+
+    def sheet(self, spreadsheet_id, title):
+        # Returns a sheet's cells as {(row, column): value}, for assertions.
+        for sheet in self._spreadsheets[spreadsheet_id].values():
+            if sheet['title'] == title:
+                return sheet['cells']
+        raise KeyError(title)
+
+    def spreadsheet_id(self, name):
+        return next(f['id'] for f in self._files.values() if f['name'] == name)
+
+    def get_spreadsheet(self, spreadsheet_id, query, body):
+        if spreadsheet_id not in self._spreadsheets:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        sheets = self._spreadsheets[spreadsheet_id]
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'sheets': [{'properties': {'sheetId': i, 'title': s['title']}} for i, s in sheets.items()],
+        }
+
+    def batch_update(self, spreadsheet_id, query, body):
+        if spreadsheet_id not in self._spreadsheets:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        sheets = self._spreadsheets[spreadsheet_id]
+        with self._lock:
+            for request in json.loads(body)['requests']:
+                if 'updateSheetProperties' in request:
+                    properties = request['updateSheetProperties']['properties']
+                    if 'title' in properties:
+                        sheets[properties['sheetId']]['title'] = properties['title']
+                elif 'deleteSheet' in request:
+                    del sheets[request['deleteSheet']['sheetId']]
+                elif 'updateCells' in request:
+                    update = request['updateCells']
+                    cells = sheets[update['start']['sheetId']]['cells']
+                    for r, row in enumerate(update['rows']):
+                        for c, value in enumerate(row['values']):
+                            entered = value.get('userEnteredValue', {})
+                            cells[update['start']['rowIndex'] + r, update['start']['columnIndex'] + c] = (
+                                next(iter(entered.values())) if entered else ''
+                            )
+                else:
+                    return 400, {'error': {'code': 400, 'message': f'Unsupported request {list(request)}'}}
+        return {'spreadsheetId': spreadsheet_id, 'replies': []}
+
+    def update_values(self, spreadsheet_id, query, body):
+        if spreadsheet_id not in self._spreadsheets:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        updated = 0
+        with self._lock:
+            for data in json.loads(body)['data']:
+                cells, (top, left), _ = self._range(spreadsheet_id, data['range'])
+                values = data['values']
+                if data.get('majorDimension', 'ROWS') == 'COLUMNS':
+                    values = [list(r) for r in zip(*values)]
+                for r, row in enumerate(values):
+                    for c, value in enumerate(row):
+                        cells[top + r, left + c] = value
+                        updated += 1
+        return {'spreadsheetId': spreadsheet_id, 'totalUpdatedCells': updated}
+
+    def get_values(self, spreadsheet_id, query, body):
+        if spreadsheet_id not in self._spreadsheets:
+            return 404, {'error': {'code': 404, 'message': 'Requested entity was not found.'}}
+        unformatted = query.get('valueRenderOption', [''])[0] == 'UNFORMATTED_VALUE'
+        columns = query.get('majorDimension', ['ROWS'])[0] == 'COLUMNS'
+        value_ranges = []
+        with self._lock:
+            for range_ in query.get('ranges', []):
+                cells, (top, left), (bottom, right) = self._range(spreadsheet_id, range_)
+                rows = [
+                    [cells.get((r, c), '') for c in range(left, right + 1)]
+                    for r in range(top, bottom + 1)
+                ]
+                if not unformatted:
+                    rows = [[_formatted(v) for v in row] for row in rows]
+                if columns:
+                    rows = [list(c) for c in zip(*rows)]
+                value_range = {'range': range_, 'majorDimension': 'COLUMNS' if columns else 'ROWS'}
+                values = _trim(rows)
+                if values:
+                    value_range['values'] = values
+                value_ranges.append(value_range)
+        return {'spreadsheetId': spreadsheet_id, 'valueRanges': value_ranges}
+
+    def _range(self, spreadsheet_id, range_):
+        title, start, end = parse_a1_range(range_)
+        for sheet in self._spreadsheets[spreadsheet_id].values():
+            if sheet['title'] == title:
+                return sheet['cells'], start, end
+        raise KeyError(f'Unable to parse range: {range_}')
+
+
+def parse_a1_range(range_):
+    # Returns the sheet title and the zero-based (row, column) of the range's first and last cells.
+    title, cells = range_.rsplit('!', 1)
+    corners = []
+    for cell in cells.split(':'):
+        letters = cell.rstrip('0123456789')
+        column = 0
+        for letter in letters.upper():
+            column = column * 26 + ord(letter) - ord('A') + 1
+        corners.append((int(cell[len(letters):]) - 1, column - 1))
+    return title.strip("'"), corners[0], corners[-1]
+
+
+def _response(result):
+    return result if isinstance(result, tuple) else (200, result)
+
+
+def _page(query):
+    return int(query.get('count', ['10'])[0]), int(query.get('offset', ['0'])[0])
+
+
+def _formatted(value):
+    if isinstance(value, bool):
+        return str(value).upper()
+    return value if isinstance(value, str) else str(value)
+
+
+def _trim(rows):
+    # Sheets leaves out trailing empty cells and rows.
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+ROUTES = [
+    ('POST', r'/token', None, Emulator.token),
+    ('GET', r'/discovery/v1/apis/([^/]+)/([^/]+)/rest', None, Emulator.discovery),
+    ('GET', r'/3\.0/search-campaigns', 'mailchimp', Emulator.search_campaigns),
+    ('GET', r'/3\.0/reports/([^/]+)', 'mailchimp', Emulator.report),
+    ('GET', r'/3\.0/reports/([^/]+)/click-details', 'mailchimp', Emulator.click_details),
+    ('GET', r'/3\.0/reports/([^/]+)/click-details/([^/]+)/members', 'mailchimp', Emulator.link_members),
+    ('GET', r'/3\.0/reports/([^/]+)/email-activity', 'mailchimp', Emulator.email_activity),
+    ('POST', r'/3\.0/batches', 'mailchimp', Emulator.create_batch),
+    ('GET', r'/3\.0/batches', 'mailchimp', Emulator.list_batches),
+    ('GET', r'/3\.0/batches/([^/]+)', 'mailchimp', Emulator.get_batch),
+    ('GET', r'/batch-results/([^/]+)\.tar\.gz', None, Emulator.batch_results),
+    ('GET', r'/drive/v3/files', 'drive', Emulator.list_files),
+    ('GET', r'/drive/v3/files/([^/]+)', 'drive', Emulator.get_file),
+    ('POST', r'/drive/v3/files/([^/]+)/copy', 'drive', Emulator.copy_file),
+    ('DELETE', r'/drive/v3/files/([^/]+)', 'drive', Emulator.delete_file),
+    ('GET', r'/v4/spreadsheets/([^/:]+)', 'sheets-read', Emulator.get_spreadsheet),
+    ('POST', r'/v4/spreadsheets/([^/:]+):batchUpdate', 'sheets-write', Emulator.batch_update),
+    ('POST', r'/v4/spreadsheets/([^/:]+)/values:batchUpdate', 'sheets-write', Emulator.update_values),
+    ('GET', r'/v4/spreadsheets/([^/:]+)/values:batchGet', 'sheets-read', Emulator.get_values),
+]
+
+
+def _method(method_id, http_method, path, parameters=(), repeated=(), body=False):
+    params = {
+        name: {'type': 'string', 'location': 'path' if '{' + name + '}' in path else 'query',
+               'required': '{' + name + '}' in path, **({'repeated': True} if name in repeated else {})}
+        for name in parameters
+    }
+    method = {
+        'id': method_id, 'path': path, 'httpMethod': http_method, 'parameters': params,
+        'parameterOrder': [n for n in parameters if params[n]['required']], 'response': {'$ref': 'Object'},
+    }
+    if body:
+        method['request'] = {'$ref': 'Object'}
+    return method
+
+
+def _discovery(name, version, service_path, resources):
+    return {
+        'kind': 'discovery#restDescription', 'discoveryVersion': 'v1', 'id': f'{name}:{version}', 'name': name,
+        'version': version, 'servicePath': service_path, 'batchPath': 'batch', 'protocol': 'rest',
+        'parameters': {p: {'type': 'string', 'location': 'query'} for p in ('fields', 'alt', 'key', 'prettyPrint')},
+        'schemas': {'Object': {'id': 'Object', 'type': 'object'}},
+        'resources': resources,
+    }
+
+
+# Just the methods google_sheet.py calls.
+DISCOVERY = {
+    ('sheets', 'v4'): _discovery('sheets', 'v4', '', {'spreadsheets': {
+        'methods': {
+            'get': _method('sheets.spreadsheets.get', 'GET', 'v4/spreadsheets/{spreadsheetId}', ['spreadsheetId']),
+            'batchUpdate': _method(
+                'sheets.spreadsheets.batchUpdate', 'POST', 'v4/spreadsheets/{spreadsheetId}:batchUpdate',
+                ['spreadsheetId'], body=True,
+            ),
+        },
+        'resources': {'values': {'methods': {
+            'batchUpdate': _method(
+                'sheets.spreadsheets.values.batchUpdate', 'POST', 'v4/spreadsheets/{spreadsheetId}/values:batchUpdate',
+                ['spreadsheetId'], body=True,
+            ),
+            'batchGet': _method(
+                'sheets.spreadsheets.values.batchGet', 'GET', 'v4/spreadsheets/{spreadsheetId}/values:batchGet',
+                ['spreadsheetId', 'ranges', 'majorDimension', 'valueRenderOption'], repeated=['ranges'],
+            ),
+        }}},
+    }}),
+    ('drive', 'v3'): _discovery('drive', 'v3', 'drive/v3/', {'files': {'methods': {
+        'get': _method('drive.files.get', 'GET', 'files/{fileId}', ['fileId']),
+        'list': _method('drive.files.list', 'GET', 'files', ['q', 'orderBy', 'pageSize', 'pageToken']),
+        'copy': _method('drive.files.copy', 'POST', 'files/{fileId}/copy', ['fileId'], body=True),
+        'delete': _method('drive.files.delete', 'DELETE', 'files/{fileId}', ['fileId']),
+    }}}),
+}
+
+
+class EmulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    emulator = None
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, content, *headers = self.emulator.handle(method, url.path, parse_qs(url.query), body, self.headers)
+        headers = headers[0] if headers else {}
+        truncate = headers.pop(TRUNCATE_HEADER, None)
+        if not isinstance(content, bytes):
+            content = json.dumps(content).encode()
+            headers.setdefault('Content-Type', 'application/json; charset=UTF-8')
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if truncate:
+            # Announces the whole body but sends half of it, like a connection reset mid-download.
+            self.wfile.write(content[:len(content) // 2])
+            self.close_connection = True
+            return
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main(argv=None):
+    parser = ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to every API call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='± seconds of random latency')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of API calls answered with 429')
+    parser.add_argument('--mailchimp-connections', type=int, default=10)
+    parser.add_argument('--sheets-reads-per-minute', type=int)
+    parser.add_argument('--sheets-writes-per-minute', type=int)
+    parser.add_argument('--batch-delay', type=float, default=5.0, help='seconds until a batch finishes')
+    parser.add_argument('--failed-operations', type=int, default=0, help='batch operations answered with 500')
+    parser.add_argument('--broken-downloads', type=int, default=0, help='batch result downloads cut off halfway')
+    parser.add_argument('--links', type=int, default=20)
+    parser.add_argument('--members', type=int, default=5000, help='clickers per link')
+    args = parser.parse_args(argv)
+
+    emulator = Emulator(
+        port=args.port, latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+        mailchimp_connections=args.mailchimp_connections, sheets_reads_per_minute=args.sheets_reads_per_minute,
+        sheets_writes_per_minute=args.sheets_writes_per_minute, batch_delay=args.batch_delay,
+        failed_operations=args.failed_operations, broken_downloads=args.broken_downloads, links=args.links, members=args.members,
+    )
+    for name, value in emulator.env().items():
+        print(f'export {name}={value!r}')
+    try:
+        emulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
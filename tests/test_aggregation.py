@@ -0,0 +1,69 @@
+from aggregation import MemberTable, ClickAggregate, ClickEstimate
+from sketches import HyperLogLog
+
+
+def _members(*pairs):
+    return [{'email_address': e, 'clicks': c} for e, c in pairs]
+
+
+def test_intern_is_stable():
+    table = MemberTable()
+    assert table.intern('a@x.org') == table.intern('a@x.org') == 0
+    assert table.intern('b@x.org') == 1 and len(table) == 2
+
+
+def test_repeated_member_counted_once_per_link():
+    aggregate = ClickAggregate(MemberTable())
+    aggregate.add_page('https://a', 'l1', _members(('a', 2), ('b', 1)))
+    aggregate.add_page('https://a', 'l1', _members(('b', 1), ('c', 4)))
+    assert {'total': 7, 'unique': 3} == aggregate.as_dict()['https://a']
+
+
+def test_unique_across_links_of_same_url():
+    aggregate = ClickAggregate(MemberTable())
+    aggregate.add_page('https://a', 'l1', _members(('a', 2)))
+    aggregate.add_page('https://a', 'l2', _members(('a', 1), ('b', 1)))
+    assert {'total': 4, 'unique': 2} == aggregate.as_dict()['https://a']
+
+
+def test_campaign_wide_and_overlap():
+    aggregate = ClickAggregate(MemberTable())
+    aggregate.add_page('https://a', 'l1', _members(('a', 1), ('b', 1)))
+    aggregate.add_page('https://b', 'l2', _members(('b', 1), ('c', 1)))
+    assert aggregate.any_clickers() == 3 and aggregate.overlap('https://a', 'https://b') == 1
+
+
+def test_state_round_trip_into_another_member_table():
+    aggregate = ClickAggregate(MemberTable())
+    aggregate.add_page('https://a', 'l1', _members(('a', 2), ('b', 1)))
+    aggregate.add_page('https://b', 'l2', _members(('b', 3)))
+    other = MemberTable()
+    other.intern('z')
+    restored = ClickAggregate.from_state(aggregate.to_state(), other)
+    restored.add_page('https://a', 'l1', _members(('a', 2)))
+    assert restored.as_dict() == aggregate.as_dict() and restored.overlap('https://a', 'https://b') == 1
+
+
+def test_new_clicks_add_to_members_already_counted():
+    aggregate = ClickAggregate(MemberTable())
+    aggregate.add_page('https://a', 'l1', _members(('a', 2)))
+    aggregate.add_new_clicks('https://a', 'l1', [('a', 1), ('b', 1)])
+    assert {'total': 4, 'unique': 2} == aggregate.as_dict()['https://a']
+    assert [(u, list(m), list(c)) for u, m, c in aggregate.member_clicks()] == [('https://a', [0, 1], [3, 1])]
+
+
+def test_new_clicks_add_to_members_of_a_restored_aggregate():
+    aggregate = ClickAggregate(MemberTable())
+    aggregate.add_page('https://a', 'l1', _members(('a', 2), ('b', 1)))
+    restored = ClickAggregate.from_state(aggregate.to_state(), MemberTable())
+    restored.add_new_clicks('https://a', 'l1', [('b', 2)])
+    assert [(u, list(c)) for u, m, c in restored.member_clicks()] == [('https://a', [2, 3])]
+
+
+def test_estimate_error_includes_sampling():
+    estimate = ClickEstimate()
+    estimate.add_link_sample('https://a', 2, _members(('a', 1), ('b', 3)))
+    assert estimate.error == HyperLogLog().error
+    estimate.add_link_sample('https://b', 400, _members(*((str(i), i % 3) for i in range(100))))
+    assert estimate.sampling_error('https://b') > 0
+    assert estimate.error > max(HyperLogLog().error, estimate.sampling_error('https://b'))
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta, timezone
+from cache import ResponseCache
+
+
+def _sent(days_ago):
+    return (datetime.now(timezone.utc) - timedelta(days=days_ago)).isoformat()
+
+
+def test_fetch_caches_response(tmp_path):
+    cache = ResponseCache(tmp_path)
+    calls = []
+    for _ in range(2):
+        value = cache.fetch(lambda: calls.append(1) or {'opens': 1}, 'reports', 'abc', 'opens')
+    assert value == {'opens': 1} and len(calls) == 1 and (cache.hits, cache.misses) == (1, 1)
+
+
+def test_keys_include_fields_and_params(tmp_path):
+    cache = ResponseCache(tmp_path)
+    cache.set({'page': 0}, 'members', 'abc', 'f', {'offset': 0})
+    assert cache.get('members', 'abc', 'f', {'offset': 1000}) is None
+    assert cache.get('members', 'abc', 'g', {'offset': 0}) is None
+
+
+def test_ttl_depends_on_campaign_age(tmp_path):
+    cache = ResponseCache(tmp_path)
+    cache.register_campaign('new', _sent(1))
+    cache.register_campaign('old', _sent(200))
+    assert cache.ttl('new') > 0 and cache.ttl('old') is None
+
+
+def test_campaign_ages_persist(tmp_path):
+    ResponseCache(tmp_path).register_campaign('old', _sent(200))
+    assert ResponseCache(tmp_path).ttl('old') is None
+
+
+def test_disabled_cache_bypasses_store(tmp_path):
+    cache = ResponseCache(tmp_path)
+    cache.set({'opens': 1}, 'reports', 'abc')
+    cache.enabled = False
+    assert cache.get('reports', 'abc') is None
+
+
+def test_expired_responses_are_evicted_on_open(tmp_path):
+    cache = ResponseCache(tmp_path)
+    cache.set({'opens': 1}, 'reports', 'abc', 'opens')
+    cache.register_campaign('old', _sent(200))
+    cache.set({'opens': 2}, 'reports', 'old', 'opens')
+    cache._connection().execute('UPDATE responses SET expires = 0 WHERE expires IS NOT NULL')
+    cache._connection().commit()
+    reopened = ResponseCache(tmp_path)
+    assert reopened._connection().execute('SELECT COUNT(*) FROM responses').fetchone() == (1,)
+    assert reopened.get('reports', 'old', 'opens') == {'opens': 2}
@@ -0,0 +1,51 @@
+import json
+import decoding
+from decoding import decode_member_file, decode_member_files, pooled
+
+
+def _member_file(pages):
+    return json.dumps([
+        {'operation_id': f'l1/{offset}', 'status_code': 200,
+         'response': json.dumps({'total_items': 3, 'members': [{'email_address': e, 'clicks': c} for e, c in members]})}
+        for offset, members in pages
+    ] + [
+        {'operation_id': 'l2/0', 'status_code': 404, 'response': '{"title": "Resource Not Found"}'},
+        {'operation_id': 'l3/0'},
+    ]).encode()
+
+
+def test_decode_member_file_returns_compact_pages():
+    results = decode_member_file(_member_file([(0, [('a', 1), ('b', 2)]), (2, [('c', 4)])]))
+    assert results == [
+        ('l1/0', 200, (3, [('a', 1), ('b', 2)])),
+        ('l1/2', 200, (3, [('c', 4)])),
+        ('l2/0', 404, '{"title": "Resource Not Found"}'),
+    ]
+
+
+def test_pooled_decoding_matches_inline():
+    files = [_member_file([(i, [(f'm{i}', i)])]) for i in range(5)]
+    inline = list(decode_member_files(files, mode='inline'))
+    assert sorted(decode_member_files(files, mode='pool')) == sorted(inline)
+
+
+def test_auto_mode_crossover(monkeypatch):
+    monkeypatch.setattr(decoding, 'DECODE_WORKERS', 4)
+    assert not pooled(decoding.POOL_THRESHOLD - 1, 'auto')
+    assert pooled(decoding.POOL_THRESHOLD, 'auto')
+    assert pooled(1, 'pool') and not pooled(10 ** 9, 'inline')
+    monkeypatch.setattr(decoding, 'DECODE_WORKERS', 1)
+    assert not pooled(10 ** 9, 'auto')
+
+
+def test_usable_cpus_honours_the_cgroup_quota(tmp_path):
+    (tmp_path / 'cpu.max').write_text('100000 100000\n')
+    assert decoding.usable_cpus(str(tmp_path)) == 1
+    (tmp_path / 'cpu.max').write_text('max 100000\n')
+    assert decoding.usable_cpus(str(tmp_path)) == decoding.usable_cpus(str(tmp_path / 'none')) >= 1
+
+    v1 = tmp_path / 'v1'
+    (v1 / 'cpu').mkdir(parents=True)
+    (v1 / 'cpu' / 'cpu.cfs_quota_us').write_text('50000\n')
+    (v1 / 'cpu' / 'cpu.cfs_period_us').write_text('100000\n')
+    assert decoding.usable_cpus(str(v1)) == 1
@@ -0,0 +1,257 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
+from time import time
+from pytest import fixture, mark, raises
+import mailchimp3
+import requests
+import batches
+import cache
+import checkpoint
+import google_sheet
+import history
+import main as app
+import ratelimit
+import retry
+from utils import lazy
+from emulator import Emulator, parse_a1_range
+
+
+@fixture
+def emulator(monkeypatch, tmp_path):
+    emulator = Emulator(links=6, urls=3, members=2500, batch_delay=0.2).start()
+    for name, value in emulator.env().items():
+        monkeypatch.setenv(name, value)
+    monkeypatch.setattr(app, 'MAILCHIMP_URL', emulator.env()['INSIGHT_MAILCHIMP_URL'])
+    monkeypatch.setattr(app, 'mc_client', None)
+    monkeypatch.setattr(google_sheet, 'DISCOVERY_URL', emulator.env()['INSIGHT_DISCOVERY_URL'])
+    monkeypatch.setattr(google_sheet, 'SSM_ENDPOINT', emulator.url)
+    monkeypatch.setattr(google_sheet, 'SPREADSHEET_INDEX', google_sheet.SpreadsheetIndex(str(tmp_path / 'index.json')))
+    for name in ('secrets', 'google_credentials', 'sheets_client', 'drive_client', 'spreadsheet_folder'):
+        monkeypatch.setattr(google_sheet, name, lazy(getattr(google_sheet, name).__wrapped__))
+    monkeypatch.setattr(batches, 'POLL_MIN_INTERVAL', 0.1)
+    monkeypatch.setattr(app, 'HISTORY', history.HistoryStore(str(tmp_path / 'history')))
+    # Checkpoints, cached responses and module state must not leak in from other runs or tests.
+    monkeypatch.setattr(checkpoint, 'STATE_DIR', str(tmp_path / 'state'))
+    monkeypatch.setattr(app, 'CheckpointStore', partial(checkpoint.CheckpointStore, str(tmp_path / 'state')))
+    monkeypatch.setattr(app, 'CACHE', cache.ResponseCache(str(tmp_path / 'cache')))
+    monkeypatch.setattr(app, 'MailChimp', mailchimp3.MailChimp)
+    monkeypatch.setattr(app, 'send_times', {})
+    yield emulator
+    emulator.stop()
+
+
+def _campaign_id(emulator):
+    campaign_name = app.extrapolate_vars()[0]
+    return emulator.search_campaigns({'query': [campaign_name]}, b'')['results'][0]['campaign']['id']
+
+
+def _url_totals(emulator, campaign_id):
+    expected = {}
+    for link in emulator._campaign(campaign_id).values():
+        totals = expected.setdefault(link['url'], [0, set()])
+        totals[0] += sum(m['clicks'] for m in link['members'])
+        totals[1].update(m['email_address'] for m in link['members'])
+    return expected
+
+
+def _assert_exact_rows(emulator, campaign_id, cells):
+    expected = _url_totals(emulator, campaign_id)
+    report = emulator.report(campaign_id, {}, b'')['clicks']
+    rows = {cells[r, 2]: (cells[r, 3], cells[r, 4]) for r in range(5, 5 + len(expected))}
+    assert rows == {
+        url: (total / report['clicks_total'], len(clickers) / report['unique_clicks'])
+        for url, (total, clickers) in expected.items()
+    }
+
+
+@mark.parametrize('direct_fetch_max_pages', [0, 100])
+def test_main_writes_the_exact_report(emulator, monkeypatch, direct_fetch_max_pages):
+    monkeypatch.setattr(app, 'DIRECT_FETCH_MAX_PAGES', direct_fetch_max_pages)
+    app.main(['--no-cache'])
+    assert bool(emulator._batches) == (direct_fetch_max_pages == 0)
+
+    campaign_name, spreadsheet_name, sheet_name = app.extrapolate_vars()
+    spreadsheet_id = emulator.spreadsheet_id(spreadsheet_name)
+    cells = emulator.sheet(spreadsheet_id, sheet_name)
+    campaign_id = _campaign_id(emulator)
+    _assert_exact_rows(emulator, campaign_id, cells)
+    assert cells[1, 1] == 0.5
+    first_day = datetime.strptime(spreadsheet_name, google_sheet.SPREADSHEET_NAME_FORMAT)
+    first_friday = google_sheet.get_all_fridays_for_the_month(first_day)[0]
+    assert emulator.sheet(spreadsheet_id, 'Master')[10, 8] == first_friday.strftime(google_sheet.SHEET_NAME_FORMAT)
+    totals = _url_totals(emulator, campaign_id)
+    assert app.HISTORY.url_clicks() == {url: (total, 1) for url, (total, _) in totals.items() if total}
+
+
+@mark.parametrize('failures, writes_per_refresh', [(0, [1, 0]), (1, [0, 1])])
+def test_watch_folds_new_activity_into_changed_cells(emulator, monkeypatch, failures, writes_per_refresh):
+    campaign_id = _campaign_id(emulator)
+    link_id, link = next(iter(emulator._campaign(campaign_id).items()))
+    clock = [time()]
+    writes = []
+    fetch_email_activity = app.fetch_email_activity
+
+    def failing_fetch(*args):
+        # The first refreshes fail, and the clicks they missed are folded in by the next one.
+        if len(writes) <= failures:
+            raise RuntimeError('Mailchimp is down')
+        return fetch_email_activity(*args)
+
+    def sleep(seconds):
+        # Sent a day ago and refreshed every 10 hours: three refreshes until 48 hours after the send.
+        clock[0] += seconds
+        writes.append(emulator.requests['sheets-write'])
+        if len(writes) == 1:
+            emulator.click(campaign_id, link_id, link['members'][0]['email_address'], 2)
+            emulator.click(campaign_id, link_id, 'new@example.com')
+    monkeypatch.setattr(app, 'time', lambda: clock[0])
+    monkeypatch.setattr(app, 'sleep', sleep)
+    monkeypatch.setattr(app, 'fetch_email_activity', failing_fetch)
+    app.main(['--no-cache', '--watch', '600'])
+
+    _, spreadsheet_name, sheet_name = app.extrapolate_vars()
+    _assert_exact_rows(emulator, campaign_id, emulator.sheet(emulator.spreadsheet_id(spreadsheet_name), sheet_name))
+    assert [writes[1] - writes[0], emulator.requests['sheets-write'] - writes[1]] == writes_per_refresh
+
+
+def test_diff_mode_only_writes_changed_cells(emulator):
+    app.main(['--no-cache'])
+    reads, writes = emulator.requests['sheets-read'], emulator.requests['sheets-write']
+    app.main(['--no-cache', '--diff'])
+    assert (emulator.requests['sheets-read'] - reads, emulator.requests['sheets-write'] - writes) == (1, 0)
+
+    campaign_id = _campaign_id(emulator)
+    link_id, link = next(iter(emulator._campaign(campaign_id).items()))
+    emulator.click(campaign_id, link_id, link['members'][0]['email_address'])
+    writes = emulator.requests['sheets-write']
+    app.main(['--no-cache', '--diff'])
+    assert emulator.requests['sheets-write'] - writes == 1
+    _, spreadsheet_name, sheet_name = app.extrapolate_vars()
+    _assert_exact_rows(emulator, campaign_id, emulator.sheet(emulator.spreadsheet_id(spreadsheet_name), sheet_name))
+
+
+def test_failed_batch_operations_are_fetched_directly(emulator, monkeypatch):
+    monkeypatch.setattr(app, 'DIRECT_FETCH_MAX_PAGES', 0)
+    emulator.failed_operations = 3
+    app.main(['--no-cache'])
+    assert emulator.failed_operations == 0
+    _, spreadsheet_name, sheet_name = app.extrapolate_vars()
+    cells = emulator.sheet(emulator.spreadsheet_id(spreadsheet_name), sheet_name)
+    _assert_exact_rows(emulator, _campaign_id(emulator), cells)
+
+
+def test_failed_estimate_still_writes_the_exact_report(emulator, monkeypatch):
+    def estimate_clicks_by_url(campaign_id, url_link_ids, fraction):
+        raise RuntimeError('sampling failed')
+    monkeypatch.setattr(app, 'estimate_clicks_by_url', estimate_clicks_by_url)
+    app.main(['--no-cache', '--approximate'])
+    _, spreadsheet_name, sheet_name = app.extrapolate_vars()
+    cells = emulator.sheet(emulator.spreadsheet_id(spreadsheet_name), sheet_name)
+    _assert_exact_rows(emulator, _campaign_id(emulator), cells)
+
+
+def test_broken_batch_download_is_retried(emulator, monkeypatch):
+    monkeypatch.setattr(app, 'DIRECT_FETCH_MAX_PAGES', 0)
+    monkeypatch.setattr(retry, 'sleep', lambda seconds: None)
+    emulator.broken_downloads = 1
+    app.main(['--no-cache'])
+    assert emulator.broken_downloads == 0
+    _, spreadsheet_name, sheet_name = app.extrapolate_vars()
+    cells = emulator.sheet(emulator.spreadsheet_id(spreadsheet_name), sheet_name)
+    _assert_exact_rows(emulator, _campaign_id(emulator), cells)
+
+
+def test_run_fails_when_a_failed_page_cannot_be_fetched(emulator, monkeypatch):
+    def fetch_members_page(campaign_id, link_id, offset):
+        raise RuntimeError('still failing')
+    monkeypatch.setattr(app, 'DIRECT_FETCH_MAX_PAGES', 0)
+    monkeypatch.setattr(app, 'fetch_members_page', fetch_members_page)
+    emulator.failed_operations = 1
+    with raises(RuntimeError):
+        app.main(['--no-cache'])
+
+
+def test_new_spreadsheet_is_set_up_without_cell_writes(emulator):
+    spreadsheet_id = google_sheet.get_or_create_spreadsheet('2021-01 January')
+    titles = sorted(s['title'] for s in emulator._spreadsheets[spreadsheet_id].values())
+    assert titles == ['January 1', 'January 15', 'January 22', 'January 29', 'January 8', 'Master']
+    assert emulator.sheet(spreadsheet_id, 'Master')[10, 8] == 'January 1'
+
+
+def test_copy_that_cannot_be_set_up_is_deleted(emulator, monkeypatch):
+    def initialize_sheets(spreadsheet_id, fridays):
+        raise RuntimeError('setup failed')
+    monkeypatch.setattr(google_sheet, 'initialize_sheets', initialize_sheets)
+    with raises(RuntimeError):
+        google_sheet.get_or_create_spreadsheet('2021-01 January')
+    assert [f['name'] for f in emulator._files.values()] == ['Template']
+    assert google_sheet.SPREADSHEET_INDEX.get('2021-01 January') is None
+
+
+@mark.parametrize('template_parents', [None, ['somewhere-else']])
+def test_lookup_falls_back_to_the_name(emulator, monkeypatch, tmp_path, template_parents):
+    # The template's folder is not visible, or the copies land outside the folder listed.
+    spreadsheet_id = google_sheet.get_or_create_spreadsheet('2021-01 January')
+    if template_parents is None:
+        del emulator._files[google_sheet.METRICS_SPREADSHEET_TEMPLATE]['parents']
+    else:
+        emulator._files[google_sheet.METRICS_SPREADSHEET_TEMPLATE]['parents'] = template_parents
+    monkeypatch.setattr(google_sheet, 'spreadsheet_folder', lazy(google_sheet.spreadsheet_folder.__wrapped__))
+    monkeypatch.setattr(google_sheet, 'SPREADSHEET_INDEX', google_sheet.SpreadsheetIndex(str(tmp_path / 'other.json')))
+    assert google_sheet.get_or_create_spreadsheet('2021-01 January') == spreadsheet_id
+    assert [f['name'] for f in emulator._files.values()].count('2021-01 January') == 1
+
+
+def test_sheets_reads_and_writes_do_not_wait_for_pooled_connections(emulator, monkeypatch):
+    # Both Sheets limiters admit their full concurrency at once; none of it may queue on the pool.
+    for name in ('sheets-read', 'sheets-write'):
+        monkeypatch.setitem(ratelimit.LIMITERS, name, ratelimit.RateLimiter(name, concurrency=ratelimit.MAX_CONNECTIONS))
+    spreadsheets = google_sheet.sheets_client().spreadsheets()
+    spreadsheet_id = google_sheet.METRICS_SPREADSHEET_TEMPLATE
+    body = {'valueInputOption': 'RAW', 'data': [{'range': 'Master!A1', 'values': [[1]]}]}
+    calls = [spreadsheets.get(spreadsheetId=spreadsheet_id)] * ratelimit.MAX_CONNECTIONS
+    calls += [spreadsheets.values().batchUpdate(spreadsheetId=spreadsheet_id, body=body)] * ratelimit.MAX_CONNECTIONS
+    # The token exchange happens once, up front, so that the calls below only wait on the pool.
+    google_sheet.execute(calls[0])
+    emulator.latency = 1.0
+    with ThreadPoolExecutor(max_workers=len(calls)) as pool:
+        list(pool.map(google_sheet.execute, calls))
+    assert emulator.peak_active == len(calls)
+
+
+def test_connection_limit_and_quota_are_enforced():
+    emulator = Emulator(latency=0.2, mailchimp_connections=1, sheets_reads_per_minute=1).start()
+    try:
+        url = f'{emulator.url}/3.0/search-campaigns?query=x'
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            statuses = sorted(pool.map(lambda _: requests.get(url).status_code, range(2)))
+        assert statuses == [200, 429]
+
+        url = f'{emulator.url}/v4/spreadsheets/{google_sheet.METRICS_SPREADSHEET_TEMPLATE}'
+        assert [requests.get(url).status_code for _ in range(2)] == [200, 429]
+        assert emulator.throttled == {'mailchimp': 1, 'sheets-read': 1}
+    finally:
+        emulator.stop()
+
+
+def test_values_use_multi_letter_columns():
+    assert parse_a1_range("'Jan 8'!AA10:AB11") == ('Jan 8', (9, 26), (10, 27))
+    emulator = Emulator().start()
+    try:
+        base = f'{emulator.url}/v4/spreadsheets/{google_sheet.METRICS_SPREADSHEET_TEMPLATE}/values'
+        requests.post(f'{base}:batchUpdate', json={
+            'data': [{'range': 'Master!AA10:AB11', 'values': [[1, 2], [3, 4]], 'majorDimension': 'COLUMNS'}],
+        }).raise_for_status()
+        response = requests.get(f'{base}:batchGet', params={
+            'ranges': ['Master!AA10:AC12'], 'valueRenderOption': 'UNFORMATTED_VALUE',
+        }).json()
+        assert response['valueRanges'][0]['values'] == [[1, 3], [2, 4]]
+    finally:
+        emulator.stop()
+
+
+@mark.parametrize('fraction', ['0', '-0.5', '1.5', 'nan'])
+def test_sample_fraction_outside_the_unit_interval_is_rejected(fraction):
+    with raises(SystemExit):
+        app.parse_args(['--sample-fraction', fraction])
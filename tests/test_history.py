@@ -0,0 +1,54 @@
+import os
+from aggregation import ClickAggregate, MemberTable
+from history import HistoryStore
+
+
+def _aggregate(*clicks):
+    aggregate = ClickAggregate(MemberTable())
+    for url, link_id, email, count in clicks:
+        aggregate.add_clicks(url, link_id, [(email, count)])
+    return aggregate
+
+
+def test_cross_campaign_queries(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    store.append('c1', _aggregate(('https://a', 'l1', 'x', 2), ('https://a', 'l2', 'x', 1), ('https://b', 'l3', 'y', 1)),
+                 '2021-01-01T10:00:00+00:00')
+    store.append('c3', _aggregate(('https://b', 'l1', 'x', 4)), '2021-01-15T10:00:00+00:00')
+    store.append('c2', _aggregate(('https://a', 'l1', 'z', 1), ('https://b', 'l2', 'x', 1)), '2021-01-08T10:00:00+00:00')
+
+    store = HistoryStore(str(tmp_path))
+    assert [c['id'] for c in store.campaigns()] == ['c1', 'c2', 'c3']
+    assert store.engaged_members(3) == ['x']
+    assert sorted(store.engaged_members(1, last=2)) == ['x', 'z']
+    assert store.url_clicks() == {'https://a': (4, 2), 'https://b': (6, 3)}
+    assert store.url_clicks(last=1) == {'https://b': (4, 1)}
+
+
+def test_recording_a_campaign_again_replaces_it(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    store.append('c1', _aggregate(('https://a', 'l1', 'x', 1)))
+    store.append('c2', _aggregate(('https://b', 'l1', 'z', 2)), '2021-01-08T10:00:00+00:00')
+    store.append('c1', _aggregate(('https://a', 'l1', 'x', 3), ('https://a', 'l1', 'y', 1)))
+    assert store.column('member').tolist() == [1, 0, 2]
+    assert store.column('campaign').tolist() == [0, 1, 1]
+    assert sorted(os.listdir(tmp_path)) == ['campaign.1.u4', 'clicks.1.u4', 'manifest.json', 'member.1.u4',
+                                            'members.txt', 'url.1.u4']
+
+    store = HistoryStore(str(tmp_path))
+    assert [c['id'] for c in store.campaigns()] == ['c2', 'c1']
+    assert store.url_clicks() == {'https://a': (4, 1), 'https://b': (2, 1)}
+    assert sorted(store.engaged_members(1)) == ['x', 'y', 'z']
+
+
+def test_uncommitted_bytes_are_overwritten(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    store.append('c1', _aggregate(('https://a', 'l1', 'x', 1)))
+    with open(tmp_path / 'member.u4', 'ab') as f:
+        f.write(b'\xff' * 12)
+    with open(tmp_path / 'members.txt', 'a') as f:
+        f.write('partial')
+    store = HistoryStore(str(tmp_path))
+    store.append('c2', _aggregate(('https://a', 'l1', 'y', 1)))
+    assert store.column('member').tolist() == [0, 1]
+    assert HistoryStore(str(tmp_path)).emails() == ['x', 'y']
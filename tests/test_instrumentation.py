@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import pstats
+import tracemalloc
+from pytest import raises
+import requests
+import retry
+from instrumentation import Recorder, profiled, RECORDER, write_summary
+from retry import RetryPolicy
+
+
+def test_spans_credit_bytes_and_retries_to_enclosing_spans():
+    recorder = Recorder()
+    with recorder.span('write', 'stage'):
+        with recorder.span('values.batchUpdate', 'sheets'):
+            recorder.add_bytes(100)
+            recorder.add_retry()
+        recorder.add_bytes(5)
+    summary = recorder.summary()
+    assert summary['stages'][0]['name'] == 'write'
+    assert summary['stages'][0]['bytes'] == 105
+    assert summary['stages'][0]['retries'] == 1
+    assert summary['calls']['sheets:values.batchUpdate']['bytes'] == 100
+    assert summary['calls']['sheets:values.batchUpdate']['calls'] == 1
+
+
+def test_bound_work_on_pool_threads_is_credited_to_the_submitting_span():
+    recorder = Recorder()
+    with recorder.span('fetch', 'stage'):
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            list(pool.map(recorder.bind(recorder.add_bytes), [10, 20]))
+            pool.submit(recorder.add_bytes, 1000).result()
+    assert recorder.summary()['stages'][0]['bytes'] == 30
+
+
+def test_span_records_memory_peak():
+    recorder = Recorder()
+    tracemalloc.start()
+    try:
+        with recorder.span('small', 'stage') as small:
+            pass
+        with recorder.span('large', 'stage') as large:
+            buffer = bytearray(10 ** 7)
+            del buffer
+    finally:
+        tracemalloc.stop()
+    assert large.peak_memory >= 10 ** 7 > small.peak_memory
+
+
+def test_retry_policy_records_spans(monkeypatch):
+    monkeypatch.setattr(retry, 'sleep', lambda seconds: None)
+    outcomes = iter([requests.ConnectionError(), 'ok'])
+
+    def fetch():
+        outcome = next(outcomes)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    assert RetryPolicy(span_kind='mailchimp').call(fetch) == 'ok'
+    span = RECORDER.spans[-1]
+    assert (span.name, span.kind, span.retries) == ('fetch', 'mailchimp', 1)
+
+
+def test_summary_and_profile_are_written(tmp_path):
+    write_summary(str(tmp_path / 'summary.json'))
+    assert 'calls' in json.loads((tmp_path / 'summary.json').read_text())
+
+    path = str(tmp_path / 'profile.prof')
+    assert profiled(sum, [1, 2], path=path) == 3
+    assert pstats.Stats(path).total_calls > 0
+    with raises(ZeroDivisionError):
+        profiled(lambda: 1 / 0, path=path)
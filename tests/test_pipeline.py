@@ -0,0 +1,35 @@
+from time import sleep, perf_counter
+from pytest import raises
+from pipeline import Pipeline
+
+
+def test_stages_receive_dependency_results():
+    pipeline = Pipeline()
+    pipeline.stage('a', lambda: 2)
+    pipeline.stage('b', lambda: 3)
+    pipeline.stage('product', lambda a, b: a * b, 'a', 'b')
+    assert pipeline.run()['product'] == 6
+
+
+def test_independent_stages_run_concurrently():
+    pipeline = Pipeline()
+    for name in 'abc':
+        pipeline.stage(name, lambda: sleep(0.2))
+    start = perf_counter()
+    pipeline.run()
+    assert perf_counter() - start < 0.5 and set(pipeline.timings) == set('abc')
+
+
+def test_unknown_dependency_is_rejected():
+    with raises(KeyError):
+        Pipeline().stage('a', lambda b: b, 'b')
+
+
+def test_stage_failure_propagates():
+    def fail():
+        raise ValueError()
+    pipeline = Pipeline()
+    pipeline.stage('a', fail)
+    pipeline.stage('b', lambda a: a, 'a')
+    with raises(ValueError):
+        pipeline.run()
@@ -0,0 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import sleep
+from types import SimpleNamespace
+from ratelimit import RateLimiter, TokenBucket, LIMITERS, google_limiter
+
+
+def test_concurrency_is_bounded():
+    limiter = RateLimiter('test', concurrency=2)
+    lock = Lock()
+    active = []
+    peak = []
+
+    @limiter.wrap
+    def call():
+        with lock:
+            active.append(1)
+            peak.append(len(active))
+        sleep(0.01)
+        with lock:
+            active.pop()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda _: call(), range(16)))
+    assert max(peak) == 2
+    assert limiter.stats()['calls'] == 16
+    assert limiter.stats()['waited'] > 0
+
+
+def test_token_bucket_allows_burst_then_throttles(monkeypatch):
+    import ratelimit
+    now = [0.0]
+    monkeypatch.setattr(ratelimit, 'monotonic', lambda: now[0])
+    slept = []
+
+    def fake_sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+    monkeypatch.setattr(ratelimit, 'sleep', fake_sleep)
+
+    bucket = TokenBucket(60, burst=3)
+    for _ in range(3):
+        bucket.acquire()
+    assert slept == []
+    bucket.acquire()
+    assert slept == [1.0]
+
+
+def test_google_requests_are_classified():
+    read = SimpleNamespace(methodId='sheets.spreadsheets.get', method='GET')
+    write = SimpleNamespace(methodId='sheets.spreadsheets.batchUpdate', method='POST')
+    drive = SimpleNamespace(methodId='drive.files.list', method='GET')
+    assert google_limiter(read) is LIMITERS['sheets-read']
+    assert google_limiter(write) is LIMITERS['sheets-write']
+    assert google_limiter(drive) is LIMITERS['drive']
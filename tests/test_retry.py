@@ -0,0 +1,120 @@
+from pytest import fixture, raises
+import requests
+import retry
+from retry import RetryPolicy, CircuitBreaker, CircuitOpenError, RetryError, Deadline, is_retryable, retry_after
+
+
+@fixture(autouse=True)
+def no_sleep(monkeypatch):
+    slept = []
+    monkeypatch.setattr(retry, 'sleep', slept.append)
+    return slept
+
+
+def _http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+class MailChimpError(Exception):
+    pass
+
+
+class HttpError(Exception):
+    def __init__(self, status):
+        self.resp = type('Response', (dict,), {'status': status})()
+
+
+def _flaky(*outcomes):
+    outcomes = list(outcomes)
+
+    def call():
+        outcome = outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+    return call
+
+
+def test_classifies_errors_across_clients():
+    assert is_retryable(requests.ConnectTimeout())
+    assert is_retryable(_http_error(503))
+    assert is_retryable(MailChimpError({'status': 429, 'title': 'Too Many Requests'}))
+    assert is_retryable(HttpError(500))
+    assert not is_retryable(_http_error(404))
+    assert not is_retryable(MailChimpError({'status': 400}))
+    assert not is_retryable(ValueError())
+
+
+def test_retries_until_success(no_sleep):
+    call = _flaky(requests.ConnectionError(), _http_error(502), 'ok')
+    assert RetryPolicy()(call)() == 'ok' and len(no_sleep) == 2
+
+
+def test_backoff_is_jittered_and_capped(no_sleep):
+    call = _flaky(*[requests.ConnectionError()] * 6, 'ok')
+    RetryPolicy(base=1, cap=4)(call)()
+    assert all(0 <= s <= 4 for s in no_sleep)
+
+
+def test_honors_retry_after(no_sleep):
+    call = _flaky(_http_error(429, {'Retry-After': '7'}), 'ok')
+    RetryPolicy(cap=1)(call)()
+    assert no_sleep == [7.0] and retry_after(_http_error(429)) is None
+
+
+def test_non_retryable_errors_propagate_immediately(no_sleep):
+    with raises(requests.HTTPError):
+        RetryPolicy()(_flaky(_http_error(404), 'ok'))()
+    assert no_sleep == []
+
+
+def test_gives_up_after_max_attempts():
+    with raises(requests.ConnectionError):
+        RetryPolicy(max_attempts=3)(_flaky(*[requests.ConnectionError()] * 3))()
+
+
+def test_gives_up_when_budget_is_spent():
+    with raises(requests.ConnectionError):
+        RetryPolicy(budget=Deadline(0))(_flaky(requests.ConnectionError(), 'ok'))()
+
+
+def test_run_budget_starts_with_the_run(monkeypatch):
+    monkeypatch.setattr(retry, 'RUN_BUDGET', Deadline())
+    assert not retry.RUN_BUDGET.expired()
+    retry.start_run(0)
+    assert retry.RUN_BUDGET.expired()
+    retry.start_run(60)
+    assert 0 < retry.RUN_BUDGET.remaining() <= 60
+
+
+def test_until_predicate_retries_results():
+    assert RetryPolicy(until=lambda r: r != '')(_flaky('', '', 'url'))() == 'url'
+    with raises(RetryError):
+        RetryPolicy(max_attempts=2, until=bool)(_flaky('', ''))()
+
+
+def test_circuit_breaker_fails_fast_once_open():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+    policy = RetryPolicy(max_attempts=2, breaker=breaker)
+    with raises(requests.ConnectionError):
+        policy(_flaky(requests.ConnectionError(), requests.ConnectionError()))()
+    with raises(CircuitOpenError):
+        policy(_flaky('ok'))()
+
+
+def test_throttling_does_not_open_the_circuit():
+    breaker = CircuitBreaker('test', failure_threshold=5, reset_timeout=60)
+    policy = RetryPolicy(breaker=breaker)
+    throttled = [_http_error(429, {'Retry-After': '0'}) for _ in range(5)]
+    assert policy(_flaky(*throttled, 'ok'))() == 'ok'
+    unavailable = [_http_error(503, {'Retry-After': '0'}) for _ in range(5)]
+    assert policy(_flaky(*unavailable, 'ok'))() == 'ok'
+
+
+def test_a_call_keeps_its_attempts_after_opening_the_circuit():
+    breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+    policy = RetryPolicy(max_attempts=4, breaker=breaker)
+    assert policy(_flaky(*[requests.ConnectionError()] * 3, 'ok'))() == 'ok'
@@ -0,0 +1,30 @@
+from pytest import raises
+from sketches import HyperLogLog
+
+
+def _sketch(values, precision=12):
+    sketch = HyperLogLog(precision)
+    for v in values:
+        sketch.add(v)
+    return sketch
+
+
+def test_count_within_error():
+    sketch = _sketch(f'member{i}@example.org' for i in range(50000))
+    assert abs(sketch.count() - 50000) / 50000 < 4 * sketch.error
+
+
+def test_duplicates_are_not_counted():
+    sketch = _sketch(['a', 'b', 'a', 'b', 'a'])
+    assert round(sketch.count()) == 2
+
+
+def test_merge_estimates_union():
+    a = _sketch(f'm{i}' for i in range(0, 3000))
+    b = _sketch(f'm{i}' for i in range(2000, 5000))
+    assert abs((a | b).count() - 5000) / 5000 < 4 * a.error
+
+
+def test_merge_rejects_mismatched_precision():
+    with raises(ValueError):
+        HyperLogLog(10).merge(HyperLogLog(12))
@@ -0,0 +1,43 @@
+from datetime import datetime, timedelta
+from pytest import importorskip, mark
+import timezones
+
+np = importorskip('numpy')
+
+
+def test_dst_starting_on_the_first_of_the_month():
+    # November 1st 2026 is a Sunday, so DST ends that day.
+    assert datetime(2026, 11, 1, 0, 30, tzinfo=timezones.CENTRAL).dst() == timedelta(hours=1)
+    assert datetime(2026, 11, 1, 12, tzinfo=timezones.CENTRAL).dst() == timedelta(0)
+    assert datetime(2026, 11, 1, 12, tzinfo=timezones.CENTRAL).tzname() == 'CST'
+
+
+def test_transitions_are_memoized():
+    zone = timezones._DstTimezone(-6, ('CDT', 3, 2, 6, 2), ('CST', 11, 1, 6, 1))
+    datetime(2021, 7, 1, tzinfo=zone).utcoffset()
+    datetime(2021, 1, 1, tzinfo=zone).tzname()
+    assert list(zone._transitions) == [2021]
+    assert zone._transitions[2021] == (datetime(2021, 3, 14, 2), datetime(2021, 11, 7, 1))
+
+
+@mark.parametrize('zone', [timezones.CENTRAL, timezones.PACIFIC, timezones.ARIZONA, timezones.UNIVERSAL])
+def test_to_local_matches_fromtimestamp(zone):
+    epochs = np.random.default_rng(0).integers(946684800, 2000000000, 5000)
+    # Every 15 minutes for a day around each US transition.
+    for year in range(2000, 2033):
+        for transition in timezones.CENTRAL._year_transitions(year):
+            instant = int((transition - datetime(1970, 1, 1)).total_seconds())
+            epochs = np.append(epochs, np.arange(instant - 12 * 3600, instant + 12 * 3600, 900))
+
+    walls, offsets = zone.to_local(epochs)
+    expected = [np.datetime64(datetime.fromtimestamp(int(e), zone).replace(tzinfo=None), 's') for e in epochs]
+    assert (walls == np.array(expected)).all()
+    assert ((walls - epochs.astype('datetime64[s]')).astype('int64') == offsets).all()
+
+
+def test_to_local_keeps_dst_through_the_repeated_hour():
+    # 06:30 UTC on November 7th 2021 is 01:30 CDT, half an hour before clocks fall back.
+    epoch = int((datetime(2021, 11, 7, 6, 30) - datetime(1970, 1, 1)).total_seconds())
+    walls, offsets = timezones.CENTRAL.to_local([epoch, epoch + 3600])
+    assert list(offsets) == [-5 * 3600, -6 * 3600]
+    assert walls[0] == walls[1] == np.datetime64('2021-11-07T01:30:00')